@@ -0,0 +1,69 @@
+"""Compare queue times of round-robin and load-aware ~prop-builder slot selection
+
+    PYTHONPATH=. python benchmarks/bench_builder_slots.py [slots] [requests] [utilization]
+
+Every slot runs one build at a time in submission order, build durations are
+heavy tailed. Work stealing by getAvailableWorkers is not simulated.
+"""
+import sys
+import heapq
+import random
+import statistics
+
+from buildbot_pipeline import BuilderCounter
+
+
+def gen_requests(count, slots, utilization, rnd):
+    mean_duration = 60.0
+    rate = slots * utilization / mean_duration
+    t = 0.0
+    result = []
+    for _ in range(count):
+        t += rnd.expovariate(rate)
+        # lognormal with the same mean: most builds are short, a few very long
+        duration = rnd.lognormvariate(0, 1.2) * mean_duration / 2.05
+        result.append((t, duration))
+    return result
+
+
+def simulate(requests, slots, load_aware):
+    counter = BuilderCounter('~prop-builder', slots)
+    busy_until = {f'~prop-builder{i}': 0.0 for i in range(slots)}
+    # finish times of incomplete requests per slot
+    incomplete = {name: [] for name in busy_until}
+    waits = []
+    for t, duration in requests:
+        loads = None
+        if load_aware:
+            for name, finished in incomplete.items():
+                while finished and finished[0] <= t:
+                    heapq.heappop(finished)
+            loads = {name: len(finished) for name, finished in incomplete.items()}
+        name = counter.next_builder('worker', loads)
+        start = max(t, busy_until[name])
+        busy_until[name] = start + duration
+        heapq.heappush(incomplete[name], start + duration)
+        waits.append(start - t)
+    return waits
+
+
+def report(title, waits):
+    waits = sorted(waits)
+    p95 = waits[int(len(waits) * 0.95)]
+    print(f'{title} mean {statistics.mean(waits):8.1f} s   p95 {p95:8.1f} s   max {waits[-1]:8.1f} s')
+
+
+def main():
+    slots = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    utilization = float(sys.argv[3]) if len(sys.argv) > 3 else 0.7
+
+    rnd = random.Random(42)
+    requests = gen_requests(count, slots, utilization, rnd)
+    print(f'slots: {slots}, requests: {count}, utilization: {utilization}')
+    report('round-robin:', simulate(requests, slots, False))
+    report('load-aware: ', simulate(requests, slots, True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Compare file filter evaluation against the previous fnmatch.filter closures
+
+    PYTHONPATH=. python benchmarks/bench_filters.py [files] [pipelines]
+"""
+import sys
+import random
+import timeit
+import fnmatch
+
+from buildbot_pipeline import filters
+
+
+class Change:
+    def __init__(self, files):
+        self.files = files
+
+
+def gen_files(count, rnd):
+    dirs = [f'project{i}/{sub}' for i in range(50) for sub in ('src', 'tests', 'docs', 'lib/internal')]
+    return [f'{rnd.choice(dirs)}/module{i}.{rnd.choice(["py", "c", "h", "md"])}' for i in range(count)]
+
+
+def gen_patterns(count, rnd):
+    result = []
+    for i in range(count):
+        project = f'project{rnd.randrange(60)}'
+        result.append([f'{project}/src/*', f'{project}/tests/*.py', f'buildbot/pipeline{i}.yaml'])
+    return result
+
+
+def legacy_filter(patterns):
+    flts = [lambda value, p=p: bool(fnmatch.filter(value.files, p)) for p in patterns]
+    return lambda value: any(it(value) for it in flts)
+
+
+def main():
+    nfiles = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    npipelines = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+
+    rnd = random.Random(42)
+    files = gen_files(nfiles, rnd)
+    patterns = gen_patterns(npipelines, rnd)
+
+    legacy = [legacy_filter(it) for it in patterns]
+    compiled = [filters.make_filters({'files': it}) for it in patterns]
+
+    def run_legacy():
+        change = Change(files)
+        return [flt(change) for flt in legacy]
+
+    def run_compiled():
+        change = Change(files)
+        return [flt(change) for flt in compiled]
+
+    assert run_legacy() == run_compiled()
+
+    number = 5
+    t_legacy = min(timeit.repeat(run_legacy, number=number, repeat=3)) / number
+    t_compiled = min(timeit.repeat(run_compiled, number=number, repeat=3)) / number
+    print(f'files: {nfiles}, pipelines: {npipelines}')
+    print(f'legacy:   {t_legacy * 1000:.2f} ms')
+    print(f'compiled: {t_compiled * 1000:.2f} ms')
+    print(f'speedup:  {t_legacy / t_compiled:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
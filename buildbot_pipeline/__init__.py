@@ -1,6 +1,7 @@
 import itertools
 
-from twisted.internet import defer
+import sqlalchemy as sa
+from twisted.internet import defer, task
 
 from buildbot.plugins import util as _
 from buildbot.util.service import BuildbotService
@@ -11,36 +12,99 @@ from buildbot.schedulers.triggerable import Triggerable
 from buildbot.worker.local import LocalWorker
 
 from . import steps, build, file_store as _unused_important
-from . import builder as _unused_important, monkey as _unused_important
+from . import builder, monkey as _unused_important
 
 build_counters = {}
 
+# how long builder slot loads fetched from db are reused, picks made in
+# between are added to the snapshot
+LOAD_SNAPSHOT_TTL = 1.0
+
+# how often workdir pool usage is written to the master log
+WORKDIR_STATS_INTERVAL = 600
+
 
 class BuilderCounter:
     def __init__(self, prefix, amount):
         self.prefix = prefix
         self.amount = amount
         self._counters = {}
+        self._loads = None
+        self._loads_at = 0
 
-    def next_builder(self, key):
+    def next_builder(self, key, loads=None):
         try:
             c = self._counters[key]
         except KeyError:
             c = self._counters[key] = itertools.cycle(range(self.amount))
-        idx = next(c)
-        return f'{self.prefix}{idx}'
+        start = next(c)
+        if loads is None:
+            return f'{self.prefix}{start}'
+
+        # least loaded slot, ties are resolved in round-robin order
+        order = [(start + i) % self.amount for i in range(self.amount)]
+        idx = min(order, key=lambda it: loads.get(f'{self.prefix}{it}', 0))
+        name = f'{self.prefix}{idx}'
+        loads[name] = loads.get(name, 0) + 1
+        return name
+
+    @defer.inlineCallbacks
+    def get_loads(self, master):
+        now = master.reactor.seconds()
+        if self._loads is not None and now - self._loads_at < LOAD_SNAPSHOT_TTL:
+            return self._loads
+
+        names = {}
+        for i in range(self.amount):
+            bldr = master.botmaster.builders.get(f'{self.prefix}{i}')
+            if bldr:
+                names[(yield bldr.getBuilderId())] = bldr.name
+
+        def thd(conn):
+            tbl = master.db.model.buildrequests
+            q = sa.select([tbl.c.builderid, sa.func.count()]).where(
+                (tbl.c.complete == 0) & tbl.c.builderid.in_(list(names))
+            ).group_by(tbl.c.builderid)
+            return conn.execute(q).fetchall()
+
+        # incomplete requests are both queued and running ones
+        rows = yield master.db.pool.do(thd)
+        self._loads = {names[builderid]: count for builderid, count in rows}
+        self._loads_at = now
+        return self._loads
 
 
 @properties.renderer
+@defer.inlineCallbacks
 def builder_names(props):
     prefix = props.getProperty('pipeline_builder_prefix')
     worker = props.getProperty('workername', '-some-')
-    name = build_counters[prefix].next_builder(worker)
+    counter = build_counters[prefix]
+    loads = None
+    if props.master:
+        loads = yield counter.get_loads(props.master)
+    name = counter.next_builder(worker, loads)
     return [name]
 
 
 class PipelineService(BuildbotService):
     name = "pipelineService"
+    stats_loop = None
+
+    def startService(self):
+        self.stats_loop = task.LoopingCall(self.report_stats)
+        self.stats_loop.clock = self.master.reactor
+        self.stats_loop.start(WORKDIR_STATS_INTERVAL, now=False)
+        return super().startService()
+
+    def stopService(self):
+        if self.stats_loop and self.stats_loop.running:
+            self.stats_loop.stop()
+        return super().stopService()
+
+    def report_stats(self):
+        if build.PipelineBuild.workdir_pool_manager:
+            build.PipelineBuild.workdir_pool_manager.report()
 
     @defer.inlineCallbacks
     def reconfigService(self):
@@ -49,17 +113,22 @@ class PipelineService(BuildbotService):
                 conn.execute('CREATE INDEX IF NOT EXISTS bbpipe_idx_build_data_name ON build_data (name text_pattern_ops)')
             elif conn.engine.url.drivername.startswith('sqlite'):
                 conn.execute('CREATE INDEX IF NOT EXISTS bbpipe_idx_build_data_name ON build_data (name collate nocase)')
+            build.setup_tables(self.master, conn)
         yield self.master.db.pool.do(setup_indexes)
 
 
 def init_pipeline(master_config, builders=10, inner_builders=30,
-                  stepsdir=steps.DEFAULT_STEPSDIR, vcs_opts=None, workdir_pool_config=None):
+                  stepsdir=steps.DEFAULT_STEPSDIR, vcs_opts=None, workdir_pool_config=None,
+                  pipeline_cache_size=1000, gather_concurrency=8, discovery='checkout'):
     build_counters['~prop-builder'] = BuilderCounter('~prop-builder', builders)
     build_counters['~prop-inner-builder'] = BuilderCounter('~prop-inner-builder', inner_builders)
 
     if vcs_opts:
         steps._vcs_opts.update(vcs_opts)
 
+    steps.pipeline_cache.size = pipeline_cache_size
+    steps.GATHER_CONCURRENCY = gather_concurrency
+
     workers = [it.name for it in master_config['workers']]
 
     factory = BuildFactory()
@@ -73,6 +142,7 @@ def init_pipeline(master_config, builders=10, inner_builders=30,
                           workernames=workers,
                           factory=factory,
                           tags=[steps.HIDDEN],
+                          nextWorker=builder.next_worker,
                           locks=build.builder_locks))
 
     factory = BuildFactory()
@@ -91,7 +161,7 @@ def init_pipeline(master_config, builders=10, inner_builders=30,
     master_config['workers'].extend(dist_workers)
 
     factory = BuildFactory()
-    factory.addStep(steps.DistributeStep(name='get builders'))
+    factory.addStep(steps.DistributeStep(name='get builders', discovery=discovery))
     master_config['builders'].append(BuilderConfig(
         name="~distributor",
         properties={'pipeline_stepsdir': stepsdir},
@@ -1,49 +1,161 @@
 import json
+import time
+import heapq
+import itertools
 from functools import lru_cache
 
 import sqlalchemy as sa
 from twisted.internet import defer
+from twisted.python import log
 
 from buildbot.process.build import Build
 from buildbot.process.properties import renderer
+from buildbot.process.results import SUCCESS
 from buildbot.locks import WorkerLock
+from buildbot.util import eventual
 
-from buildbot_pipeline import utils
+from buildbot_pipeline import utils, file_store
 
 _current_builds = {}
 
 
+# higher priority waiters get a workdir first, equal ones are served in
+# arrival order
+WORKDIR_PRIORITY_MERGED = 10
+WORKDIR_PRIORITY_DEFAULT = 0
+
+
+# checkout state fields a free workdir is matched by, best match first
+WORKDIR_AFFINITY = ('revision', 'change', 'branch')
+
+
 class WorkdirPool:
     def __init__(self, size):
         self.size = size
-        self.occupied = set()
-        self.waiting = []
-
-    def acquire(self, token):
-        if self.size is None or len(self.occupied) < self.size:
-            idx = 0
-            while True:
-                if idx not in self.occupied:
-                    self.occupied.add(idx)
-                    token['idx'] = idx
-                    return defer.succeed(token)
-                idx += 1
+        # free heap may contain stale indexes taken by affinity, free_set is
+        # the source of truth
+        self.free = []
+        self.free_set = set()
+        self.allocated = 0
+        self.slot_state = {}
+        self.warm = {}
+        self.waiters = []
+        self.waiting = 0
+        self._seq = itertools.count()
+        self.acquired = 0
+        self.waited = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.matches = dict.fromkeys(WORKDIR_AFFINITY + (None,), 0)
+
+    def _warm_keys(self, state):
+        return [(field, state[field]) for field in WORKDIR_AFFINITY if state.get(field)]
+
+    def _put_free(self, idx):
+        self.free_set.add(idx)
+        if len(self.free) > 2 * len(self.free_set):
+            self.free = sorted(self.free_set)
         else:
-            d = defer.Deferred(canceller=self.waiting.remove)
-            self.waiting.append(d)
+            heapq.heappush(self.free, idx)
+        for key in self._warm_keys(self.slot_state.get(idx, {})):
+            self.warm.setdefault(key, set()).add(idx)
+
+    def _take(self, idx):
+        self.free_set.discard(idx)
+        for key in self._warm_keys(self.slot_state.get(idx, {})):
+            slots = self.warm[key]
+            slots.discard(idx)
+            if not slots:
+                del self.warm[key]
+
+    def _pop_free(self, state):
+        for key in self._warm_keys(state):
+            slots = self.warm.get(key)
+            if slots:
+                idx = min(slots)
+                self._take(idx)
+                return idx
+        while True:
+            idx = heapq.heappop(self.free)
+            if idx in self.free_set:
+                self._take(idx)
+                return idx
+
+    def _assign(self, token, idx, state):
+        prev = self.slot_state.get(idx, {})
+        match = next((field for field in WORKDIR_AFFINITY
+                      if state.get(field) and prev.get(field) == state[field]), None)
+        self.matches[match] += 1
+        self.acquired += 1
+        self.slot_state[idx] = state
+        token['idx'] = idx
+        token['match'] = match
+
+    def acquire(self, token, priority=WORKDIR_PRIORITY_DEFAULT, state=None):
+        state = state or {}
+        if self.free_set:
+            self._assign(token, self._pop_free(state), state)
+        elif self.size is None or self.allocated < self.size:
+            self._assign(token, self.allocated, state)
+            self.allocated += 1
+        else:
+            # cancelled waiters stay in a heap and are skipped on release
+            waiter = [-priority, next(self._seq), time.monotonic(), token, None, state]
+            waiter[4] = d = defer.Deferred(canceller=lambda _: self._cancel(waiter))
+            heapq.heappush(self.waiters, waiter)
+            self.waiting += 1
             return d
 
+        return defer.succeed(token)
+
+    def _cancel(self, waiter):
+        waiter[3] = None
+        self.waiting -= 1
+
     def release(self, token):
-        if self.waiting:
-            self.waiting.pop(0).callback(token)
-        else:
-            self.occupied.discard(token['idx'])
+        idx = token['idx']
+        while self.waiters:
+            _, _, started, wtoken, d, state = heapq.heappop(self.waiters)
+            if wtoken is None:
+                continue
+            self.waiting -= 1
+            wait = time.monotonic() - started
+            self.waited += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self._assign(wtoken, idx, state)
+            d.callback(wtoken)
+            return
+        self._put_free(idx)
+
+    def locality(self, state):
+        # best affinity field a free slot would match, 'warm' if the pool
+        # only has checkouts of other states
+        for key in self._warm_keys(state):
+            if self.warm.get(key):
+                return key[0]
+        return 'warm' if self.allocated else None
+
+    def stats(self):
+        hits = self.acquired - self.matches[None]
+        return {
+            'size': self.size,
+            'busy': self.allocated - len(self.free_set),
+            'waiting': self.waiting,
+            'acquired': self.acquired,
+            'waited': self.waited,
+            'wait_avg': self.wait_total / self.waited if self.waited else 0.0,
+            'wait_max': self.wait_max,
+            'hits': {field: self.matches[field] for field in WORKDIR_AFFINITY},
+            'hit_rate': hits / self.acquired if self.acquired else 0.0,
+        }
 
 
 class WorkdirPoolManager:
     def __init__(self, config):
         self.config = config
         self.pools = {}
+        self.reported = {}
 
     def _key_size(self, workername, project, builder):
         if project in self.config:
@@ -55,19 +167,42 @@ class WorkdirPoolManager:
             size = None
         return key, size
 
-    def acquire(self, workername, project, builder):
+    def acquire(self, workername, project, builder, priority=WORKDIR_PRIORITY_DEFAULT, state=None):
         key, size = self._key_size(workername, project, builder)
         try:
             p = self.pools[key]
         except KeyError:
             p = self.pools[key] = WorkdirPool(size)
 
-        return p.acquire({'key': key, 'is_shared': project in self.config})
+        return p.acquire({'key': key, 'is_shared': project in self.config}, priority, state)
 
     def release(self, token):
         p = self.pools.get(token['key'])
         p and p.release(token)
 
+    def locality(self, workername, project, builder, state):
+        key, _ = self._key_size(workername, project, builder)
+        p = self.pools.get(key)
+        if p is None:
+            return None, 0
+        return p.locality(state), p.waiting
+
+    def stats(self):
+        return {key: p.stats() for key, p in self.pools.items()}
+
+    def report(self):
+        # logs pools used since the previous report
+        for key, p in self.pools.items():
+            if p.acquired == self.reported.get(key) and not p.waiting:
+                continue
+            self.reported[key] = p.acquired
+            s = p.stats()
+            log.msg(f'workdir pool {":".join(map(str, key))}: busy {s["busy"]}/{s["size"] or "-"}, '
+                    f'waiting {s["waiting"]}, waited {s["waited"]}/{s["acquired"]}, '
+                    f'wait avg {s["wait_avg"]:.1f}s, max {s["wait_max"]:.1f}s, '
+                    f'hit rate {s["hit_rate"]:.0%} '
+                    + ' '.join(f'{field}={count}' for field, count in s['hits'].items()))
+
 
 @lru_cache(None)
 def get_lock(name, count):
@@ -97,37 +232,145 @@ def builder_name_to_path(name):
     return name.strip('.').replace('/', '-').replace('\\', '-').replace(':', '-')
 
 
-@defer.inlineCallbacks
-def get_bpath(master, buildid):
-    data = yield master.db.build_data.getAllBuildDataNoValues(buildid)
-    bpath = next((it['name'] for it in data or [] if it['name'].startswith('bpath:')), None)
-    if bpath:
-        return list(map(int, list(filter(None, bpath.split(':')))[1:]))
-    return []
+pipeline_metadata = sa.MetaData()
+
+# every build triggered from a pipeline refers to its parent and to the
+# root build of a pipeline
+build_tree = sa.Table(
+    'bbpipe_build_tree', pipeline_metadata,
+    sa.Column('buildid', sa.Integer, primary_key=True, autoincrement=False),
+    sa.Column('root_buildid', sa.Integer, nullable=False),
+    sa.Column('parent_buildid', sa.Integer, nullable=False),
+    sa.Column('builderid', sa.Integer, nullable=False),
+)
+sa.Index('bbpipe_idx_build_tree_root', build_tree.c.root_buildid, build_tree.c.builderid, build_tree.c.buildid)
+
+# properties shared between builds of the same builder within a pipeline
+session_props = sa.Table(
+    'bbpipe_session_props', pipeline_metadata,
+    sa.Column('root_buildid', sa.Integer, nullable=False),
+    sa.Column('builderid', sa.Integer, nullable=False),
+    sa.Column('name', sa.String(256), nullable=False),
+    sa.Column('value', sa.Text, nullable=False),
+    sa.Column('source', sa.String(256), nullable=False),
+    sa.PrimaryKeyConstraint('root_buildid', 'builderid', 'name'),
+)
+
+# successful pipeline builds by a hash of their inputs: pipeline definition
+# and repository files matched by a pipeline filter
+input_hashes = sa.Table(
+    'bbpipe_input_hashes', pipeline_metadata,
+    sa.Column('name', sa.String(256), nullable=False),
+    sa.Column('input_hash', sa.String(64), nullable=False),
+    sa.Column('buildid', sa.Integer, nullable=False),
+    sa.PrimaryKeyConstraint('name', 'input_hash', 'buildid'),
+)
+
+# moving averages of junit unit durations by shard key, see timings.py
+unit_timings = sa.Table(
+    'bbpipe_timings', pipeline_metadata,
+    sa.Column('key', sa.String(256), nullable=False),
+    sa.Column('unit', sa.String(500), nullable=False),
+    sa.Column('duration', sa.Float, nullable=False),
+    sa.Column('updated', sa.Integer, nullable=False),
+    sa.PrimaryKeyConstraint('key', 'unit'),
+)
+
+# shared part of parallel children definitions by its hash, see
+# steps.split_steps_info, rows are never removed with builds
+steps_infos = sa.Table(
+    'bbpipe_steps_info', pipeline_metadata,
+    sa.Column('hash', sa.String(64), primary_key=True),
+    sa.Column('value', sa.Text, nullable=False),
+)
+
+# one time data migrations already applied
+migrations = sa.Table(
+    'bbpipe_migrations', pipeline_metadata,
+    sa.Column('name', sa.String(64), primary_key=True),
+)
+
+MIGRATE_BATCH = 1000
+
+
+def setup_tables(master, conn):
+    pipeline_metadata.create_all(conn, checkfirst=True)
+    done = {it[0] for it in conn.execute(sa.select([migrations.c.name]))}
+    for name, table, migrate in (('build_tree', build_tree, migrate_bpath),
+                                 ('session_props', session_props, migrate_session_props)):
+        if name in done:
+            continue
+        transaction = conn.begin()
+        # tables could be filled by a migration run before markers existed
+        if not conn.execute(sa.select([table.c[0]]).limit(1)).fetchone():
+            migrate(master, conn)
+        conn.execute(migrations.insert(), {'name': name})
+        transaction.commit()
+
+
+def iter_batches(conn, q, key):
+    # keyset pagination, key must be the first selected column
+    last = None
+    while True:
+        bq = q.order_by(key).limit(MIGRATE_BATCH)
+        if last is not None:
+            bq = bq.where(key > last)
+        rows = conn.execute(bq).fetchall()
+        if not rows:
+            return
+        yield rows
+        last = rows[-1][0]
+
+
+def migrate_bpath(master, conn):
+    # one time migration from bpath:1:2:3: build_data rows
+    bd = master.db.model.build_data
+    b = master.db.model.builds
+    q = (sa.select([bd.c.id, bd.c.buildid, bd.c.name, b.c.builderid])
+         .select_from(bd.join(b, b.c.id == bd.c.buildid))
+         .where(bd.c.name.like('bpath:%')))
+    for batch in iter_batches(conn, q, bd.c.id):
+        rows = []
+        for _, buildid, name, builderid in batch:
+            ids = [int(it) for it in name.split(':')[1:] if it]
+            if ids:
+                rows.append({'buildid': buildid, 'root_buildid': ids[0],
+                             'parent_buildid': ids[-1], 'builderid': builderid})
+        if rows:
+            conn.execute(build_tree.insert(), rows)
+
+
+def get_build_root(master, buildid):
+    def thd(conn):
+        q = sa.select([build_tree.c.root_buildid]).where(build_tree.c.buildid == buildid)
+        rv = conn.execute(q).fetchone()
+        return rv and rv[0]
+    return master.db.pool.do(thd)
 
 
-def set_bpath(master, buildid, bpath):
-    name = 'bpath:' + ':'.join(map(str, bpath)) + ':'
-    return master.data.updates.setBuildData(buildid, name, b'', 'Build')
+def add_build_node(master, buildid, parent_buildid, root_buildid, builderid):
+    def thd(conn):
+        conn.execute(build_tree.insert(), {
+            'buildid': buildid, 'root_buildid': root_buildid,
+            'parent_buildid': parent_buildid, 'builderid': builderid})
+    return master.db.pool.do(thd)
 
 
-def get_child_builds(master, bpath, builderid=None, success=None):
+def get_child_builds(master, root_buildid, builderid=None, success=None):
     def thd(conn):
         b = master.db.model.builds
-        bd = master.db.model.build_data
-        name = 'bpath:' + ':'.join(map(str, bpath))
         cond = []
 
         if builderid is not None:
-            cond.append(b.c.builderid == builderid)
+            cond.append(build_tree.c.builderid == builderid)
 
         if success:
             cond.append(b.c.results == 0)
 
         q = (b.select()
-             .select_from(bd.join(b))
-             .where(bd.c.name.like(name+'%'), *cond)
-             .order_by(b.c.number.desc()))
+             .select_from(build_tree.join(b, b.c.id == build_tree.c.buildid))
+             .where(build_tree.c.root_buildid == root_buildid, *cond)
+             .order_by(build_tree.c.buildid.desc()))
 
         if success:
             q = q.limit(1)
@@ -136,15 +379,83 @@ def get_child_builds(master, bpath, builderid=None, success=None):
     return master.db.pool.do(thd)
 
 
-def get_session_props(master, buildid, builderid):
+def migrate_session_props(master, conn):
+    # one time migration from prop:<builderid>:<name> build_data rows
+    bd = master.db.model.build_data
+    q = (sa.select([bd.c.id, bd.c.buildid, bd.c.name, bd.c.value, bd.c.source])
+         .where(bd.c.name.like('prop:%')))
+    for batch in iter_batches(conn, q, bd.c.id):
+        rows = []
+        for _, buildid, name, value, source in batch:
+            _, builderid, name = name.split(':', 2)
+            rows.append({'root_buildid': buildid, 'builderid': int(builderid), 'name': name,
+                         'value': value.decode(), 'source': source})
+        conn.execute(session_props.insert(), rows)
+
+
+def get_session_props(master, root_buildid, builderid):
+    def thd(conn):
+        q = (sa.select([session_props.c.name, session_props.c.value])
+             .where(session_props.c.root_buildid == root_buildid,
+                    session_props.c.builderid == builderid))
+        return {name: json.loads(value) for name, value in conn.execute(q)}
+    return master.db.pool.do(thd)
+
+
+def set_session_props(master, root_buildid, builderid, props):
+    # props: {name: (value, source)}, written in a single transaction
     def thd(conn):
-        bd = master.db.model.build_data
-        prefix = f'prop:{builderid}:'
-        q = (sa.select([bd.c.name, bd.c.value])
-             .where(bd.c.name.like(prefix+'%'), bd.c.buildid == buildid))
-        result = {name[len(prefix):]: json.loads(value.decode())
-                  for name, value in conn.execute(q)}
-        return result
+        transaction = conn.begin()
+        conn.execute(session_props.delete().where(
+            session_props.c.root_buildid == root_buildid,
+            session_props.c.builderid == builderid,
+            session_props.c.name.in_(list(props))))
+        conn.execute(session_props.insert(), [
+            {'root_buildid': root_buildid, 'builderid': builderid, 'name': name,
+             'value': json.dumps(value), 'source': source}
+            for name, (value, source) in props.items()])
+        transaction.commit()
+    return master.db.pool.do(thd)
+
+
+def add_input_hash(master, name, input_hash, buildid):
+    def thd(conn):
+        conn.execute(input_hashes.insert(), {'name': name, 'input_hash': input_hash, 'buildid': buildid})
+    return master.db.pool.do(thd)
+
+
+def get_build_by_input_hash(master, name, input_hash):
+    def thd(conn):
+        b = master.db.model.builds
+        q = (b.select()
+             .select_from(input_hashes.join(b, b.c.id == input_hashes.c.buildid))
+             .where(input_hashes.c.name == name,
+                    input_hashes.c.input_hash == input_hash,
+                    b.c.results == 0)
+             .order_by(input_hashes.c.buildid.desc())
+             .limit(1))
+        return conn.execute(q).fetchone()
+    return master.db.pool.do(thd)
+
+
+def add_steps_info(master, h, value):
+    def thd(conn):
+        q = sa.select([steps_infos.c.hash]).where(steps_infos.c.hash == h)
+        if conn.execute(q).fetchone():
+            return
+        try:
+            conn.execute(steps_infos.insert(), {'hash': h, 'value': value})
+        except sa.exc.IntegrityError:
+            # the same definition is stored by a concurrent trigger
+            pass
+    return master.db.pool.do(thd)
+
+
+def get_steps_info(master, h):
+    def thd(conn):
+        q = sa.select([steps_infos.c.value]).where(steps_infos.c.hash == h)
+        rv = conn.execute(q).fetchone()
+        return rv and rv[0]
     return master.db.pool.do(thd)
 
 
@@ -152,6 +463,17 @@ def get_project_from_url(url):
     return (url.rpartition('/')[2] or 'unknown').strip('/')
 
 
+def get_workdir_state(props):
+    revision = props.getProperty('revision')
+    if isinstance(revision, dict):
+        revision = json.dumps(revision, sort_keys=True)
+    return {
+        'revision': revision,
+        'change': props.getProperty('event.change.number'),
+        'branch': props.getProperty('branch'),
+    }
+
+
 class PipelineBuild(Build):
     workdir_pool_manager = None
 
@@ -184,8 +506,10 @@ class PipelineBuild(Build):
 
         buildername = self.getProperty('virtual_builder_name')
         project = self.getProperty('project') or get_project_from_url(self.getProperty('repository'))
-        token = yield self.workdir_pool_manager.acquire(self.workername, project, buildername)
+        token = yield self.workdir_pool_manager.acquire(
+            self.workername, project, buildername, self.getWorkdirPriority(), self.getWorkdirState())
         self._pipeline_acquired_token = token
+        self.setProperty('workdir_match', token['match'], 'Worker')
 
         if token['is_shared']:
             parts = project, 'wc' + str(token['idx'])
@@ -201,6 +525,17 @@ class PipelineBuild(Build):
         )
         self.setProperty('wc', self.workdir, 'Worker')
 
+    def getWorkdirPriority(self):
+        priority = self.getProperty('pipeline_priority')
+        if priority is not None:
+            return int(priority)
+        if self.getProperty('event.change.status') in ('MERGED', 'TAGGED'):
+            return WORKDIR_PRIORITY_MERGED
+        return WORKDIR_PRIORITY_DEFAULT
+
+    def getWorkdirState(self):
+        return get_workdir_state(self)
+
     def releaseLocks(self):
         if hasattr(self, '_pipeline_acquired_token'):
             self.workdir_pool_manager.release(self._pipeline_acquired_token)
@@ -210,38 +545,67 @@ class PipelineBuild(Build):
     @defer.inlineCallbacks
     def startBuild(self, *args, **kwargs):
         yield super().startBuild(*args, **kwargs)
-        self.buildbot_pipeline_bpath = None
+        self.buildbot_pipeline_root = None
+        self._session_props = {}
+        self._session_props_flush = None
+        self._session_props_lock = defer.DeferredLock()
         parent_buildid = yield utils.get_parent_buildid(self.master, self.requests[0].bsid)
         if parent_buildid:
-            bpath = yield get_bpath(self.master, parent_buildid)
-            bpath.append(parent_buildid)
-            self.buildbot_pipeline_bpath = bpath
-            yield set_bpath(self.master, self.buildid, bpath)
+            root_buildid = (yield get_build_root(self.master, parent_buildid)) or parent_buildid
+            builderid = yield self.getBuilderId()
+            yield add_build_node(self.master, self.buildid, parent_buildid, root_buildid, builderid)
+            self.buildbot_pipeline_root = root_buildid
             yield self.populateSessionProperties()
 
-    @defer.inlineCallbacks
+    # session properties are buffered, all properties set within a reactor
+    # turn are written together
     def setSessionProperty(self, name, value, source='Build'):
-        if not self.buildbot_pipeline_bpath:
-            return
+        if not self.buildbot_pipeline_root:
+            return defer.succeed(None)
 
-        builderid = yield self.getBuilderId()
-        buildid = self.buildbot_pipeline_bpath[0]
-        prop = f'prop:{builderid}:{name}'
-        yield self.master.data.updates.setBuildData(buildid, prop, json.dumps(value).encode(), source)
+        self._session_props[name] = (value, source)
+        if self._session_props_flush is None:
+            self._session_props_flush = self.flushSessionProperties()
+            self._session_props_flush.addErrback(log.err, 'unable to save session properties')
+        return self._session_props_flush
+
+    def flushSessionProperties(self):
+        return self._session_props_lock.run(self._flushSessionProperties)
+
+    @defer.inlineCallbacks
+    def _flushSessionProperties(self):
+        yield eventual.fireEventually()
+        props, self._session_props = self._session_props, {}
+        self._session_props_flush = None
+        if props:
+            builderid = yield self.getBuilderId()
+            yield set_session_props(self.master, self.buildbot_pipeline_root, builderid, props)
 
     @defer.inlineCallbacks
     def populateSessionProperties(self):
         builderid = yield self.getBuilderId()
-        buildid = self.buildbot_pipeline_bpath[0]
+        buildid = self.buildbot_pipeline_root
         props = yield get_session_props(self.master, buildid, builderid)
         for name, value in props.items():
             yield self.setProperty(name, value, 'Build')
 
+    def buildFinished(self, text, results):
+        bname = builder_name_to_path(self.getProperty('virtual_builder_name') or self.getProperty('buildername'))
+        bnum = self.getProperty('pipeline_buildnumber') or self.getProperty('buildnumber')
+        file_store.ep.mark_finished(f'{bname}/{bnum}')
+
+        input_hash = self.getProperty('pipeline_input_hash')
+        if input_hash and results == SUCCESS:
+            d = add_input_hash(self.master, self.getProperty('virtual_builder_name'), input_hash, self.buildid)
+            d.addErrback(log.err, 'unable to save pipeline input hash')
+
+        return super().buildFinished(text, results)
+
     @defer.inlineCallbacks
     def get_last_successful_build(self):
-        if not self.buildbot_pipeline_bpath:
+        if not self.buildbot_pipeline_root:
             return None
 
         builderid = yield self.getBuilderId()
-        rv = yield get_child_builds(self.master, self.buildbot_pipeline_bpath[:1], builderid=builderid, success=True)
+        rv = yield get_child_builds(self.master, self.buildbot_pipeline_root, builderid=builderid, success=True)
         return rv and rv[0]
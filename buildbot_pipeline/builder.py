@@ -1,7 +1,20 @@
+import random
+
 from buildbot.process import builder
+from buildbot.process.properties import Properties
 from twisted.internet import defer
 
-from . import utils
+from . import utils, build
+
+# worker score for a ~prop-builder request by how warm its workdirs are,
+# every build already running on a worker costs one point
+LOCALITY_SCORES = {
+    'revision': 6,
+    'change': 5,
+    'branch': 4,
+    'warm': 3,
+    None: 0,
+}
 
 
 @utils.wrapit(builder.Builder)
@@ -34,3 +47,53 @@ def canStartBuild(orig, self, workerforbuilder, buildrequest):
         return orig(self, workerforbuilder, buildrequest)
 
     return defer.succeed(False)
+
+
+def request_properties(breq):
+    # properties a build of the request sees when acquiring a workdir, the same
+    # layering as Build.setupPropertiesKnownBeforeBuildStarts and
+    # Build.setupBuildProperties apply at build start
+    props = Properties()
+    sources = list(breq.sources.values())
+    for ss in sources:
+        for change in getattr(ss, 'changes', []):
+            props.updateFromProperties(change.properties)
+    props.updateFromProperties(breq.properties)
+    if len(sources) == 1:
+        ss = sources[0]
+        for name in ('branch', 'revision', 'repository', 'project'):
+            props.setProperty(name, getattr(ss, name), 'Build')
+    return props
+
+
+def worker_load(worker):
+    return sum(1 for wfb in worker.workerforbuilders.values() if wfb.isBusy())
+
+
+def next_worker(bldr, workers, buildrequest):
+    # nextWorker hook for ~prop-builder*, prefers workers with a warm checkout
+    # of the project/builder and fewer running builds
+    if not workers:
+        return None
+    manager = build.PipelineBuild.workdir_pool_manager
+    if manager is None:
+        return random.choice(workers)
+
+    props = request_properties(buildrequest)
+    project = props.getProperty('project') or build.get_project_from_url(props.getProperty('repository') or '')
+    buildername = props.getProperty('virtual_builder_name')
+    state = build.get_workdir_state(props)
+    scores = {}
+
+    def score(wfb):
+        name = wfb.worker.workername
+        try:
+            return scores[name]
+        except KeyError:
+            pass
+        match, waiting = manager.locality(name, project, buildername, state)
+        rv = scores[name] = LOCALITY_SCORES[match] - worker_load(wfb.worker) - waiting
+        return rv
+
+    best = max(score(wfb) for wfb in workers)
+    return random.choice([wfb for wfb in workers if score(wfb) == best])
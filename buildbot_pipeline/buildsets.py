@@ -0,0 +1,174 @@
+import json
+
+from twisted.internet import defer
+from twisted.python import log
+
+from buildbot.process.buildrequest import BuildRequestCollapser
+from buildbot.process.properties import Properties
+
+from buildbot_pipeline.monkey import PROP_ALL_NAME
+
+
+@defer.inlineCallbacks
+def default_sourcestamps(scheduler, sourcestamps):
+    # same merge as BaseScheduler.addBuildsetForSourceStampsWithDefaults
+    by_codebase = {ss['codebase']: ss for ss in sourcestamps or []}
+    result = []
+    for codebase in scheduler.codebases:
+        cb = yield scheduler.getCodebaseDict(codebase)
+        ss = {
+            'codebase': codebase,
+            'repository': cb.get('repository', ''),
+            'branch': cb.get('branch', None),
+            'revision': cb.get('revision', None),
+            'project': '',
+        }
+        ss.update(by_codebase.get(codebase, {}))
+        result.append(ss)
+
+    for codebase in set(by_codebase) - set(scheduler.codebases):
+        cb = by_codebase[codebase]
+        result.append({
+            'codebase': codebase,
+            'repository': cb.get('repository', ''),
+            'branch': cb.get('branch', None),
+            'revision': cb.get('revision', None),
+            'project': '',
+        })
+    return result
+
+
+def insert_buildsets(master, buildsets, sourcestampids, submitted_at, waited_for,
+                     parent_buildid, parent_relationship):
+    def thd(conn):
+        model = master.db.model
+        result = []
+        transaction = conn.begin()
+        bs_props = []
+        bs_sourcestamps = []
+        for reason, props, _ in buildsets:
+            master.db.buildsets.checkLength(model.buildsets.c.reason, reason)
+            r = conn.execute(model.buildsets.insert(), {
+                "submitted_at": submitted_at,
+                "reason": reason,
+                "complete": 0,
+                "complete_at": None,
+                "results": -1,
+                "external_idstring": None,
+                "parent_buildid": parent_buildid,
+                "parent_relationship": parent_relationship
+            })
+            bsid = r.inserted_primary_key[0]
+            result.append(bsid)
+            if props:
+                bs_props.append({"buildsetid": bsid, "property_name": PROP_ALL_NAME,
+                                 "property_value": json.dumps([props, 'buildbot_pipeline'])})
+            bs_sourcestamps.extend({"buildsetid": bsid, "sourcestampid": ssid}
+                                   for ssid in sourcestampids)
+
+        if bs_props:
+            conn.execute(model.buildset_properties.insert(), bs_props)
+        if bs_sourcestamps:
+            conn.execute(model.buildset_sourcestamps.insert(), bs_sourcestamps)
+
+        # buildrequest ids can't be recovered from a multi-row insert
+        ins = model.buildrequests.insert()
+        for i, (_, _, builderids) in enumerate(buildsets):
+            brids = {}
+            for builderid in builderids:
+                r = conn.execute(ins, {
+                    "buildsetid": result[i],
+                    "builderid": builderid,
+                    "priority": 0,
+                    "claimed_at": 0,
+                    "claimed_by_name": None,
+                    "claimed_by_incarnation": None,
+                    "complete": 0,
+                    "results": -1,
+                    "submitted_at": submitted_at,
+                    "complete_at": None,
+                    "waited_for": 1 if waited_for else 0
+                })
+                brids[builderid] = r.inserted_primary_key[0]
+            result[i] = (result[i], brids)
+
+        transaction.commit()
+        return result
+    return master.db.pool.do(thd)
+
+
+# Triggers a scheduler once per props_list entry, but creates all buildsets
+# and buildrequests in a single transaction and announces them with batched
+# events. Returns list of (bsid, brids) and list of results deferreds, the
+# same values Triggerable.trigger provides per call.
+@defer.inlineCallbacks
+def trigger_many(scheduler, props_list, waited_for, sourcestamps=None,
+                 parent_buildid=None, parent_relationship=None):
+    master = scheduler.master
+    sourcestamps = yield default_sourcestamps(scheduler, sourcestamps)
+
+    builder_ids = {it['name']: it['builderid'] for it in (yield master.data.get(('builders',)))}
+
+    buildsets = []
+    for set_props in props_list:
+        props = Properties()
+        props.updateFromProperties(scheduler.properties)
+        reason = scheduler.reason
+        if set_props:
+            props.updateFromProperties(set_props)
+            reason = set_props.getProperty('reason')
+        if reason is None:
+            reason = f"The Triggerable scheduler named '{scheduler.name}' triggered this build"
+
+        props.master = master
+        props.sourcestamps = sourcestamps
+        props.changes = []
+        builder_names = yield props.render(scheduler.builderNames)
+        props_dict = yield props.render(props.asDict())
+        buildsets.append((reason, props_dict, [builder_ids[it] for it in builder_names if it in builder_ids]))
+
+    sourcestampids = []
+    for ss in sourcestamps:
+        sourcestampids.append((yield master.db.sourcestamps.findSourceStampId(**ss)))
+
+    submitted_at = int(master.reactor.seconds())
+    ids = yield insert_buildsets(master, buildsets, sourcestampids, submitted_at,
+                                 waited_for, parent_buildid, parent_relationship)
+
+    all_brids = [brid for _, brids in ids for brid in brids.values()]
+    yield BuildRequestCollapser(master, all_brids).collapse()
+
+    ss_data = []
+    for ssid in sourcestampids:
+        ss_data.append((yield master.data.get(('sourcestamps', str(ssid)))).copy())
+
+    master.data.getResourceType('buildrequest').generateEvent(all_brids, 'new')
+    bs_resource = master.data.getResourceType('buildset')
+    results_deferreds = []
+    empty = []
+    for (bsid, brids), (reason, _, builderids) in zip(ids, buildsets):
+        bs_resource.produceEvent({
+            "bsid": bsid,
+            "external_idstring": None,
+            "reason": reason,
+            "parent_buildid": parent_buildid,
+            "submitted_at": submitted_at,
+            "complete": False,
+            "complete_at": None,
+            "results": None,
+            "scheduler": scheduler.name,
+            "sourcestamps": ss_data,
+        }, 'new')
+
+        d = defer.Deferred()
+        scheduler._waiters[bsid] = (d, brids)
+        results_deferreds.append(d)
+        if not builderids:
+            empty.append(bsid)
+
+    scheduler._updateWaiters()
+    for bsid in empty:
+        yield master.data.updates.maybeBuildsetComplete(bsid)
+
+    log.msg(f'added {len(ids)} buildsets to database')
+    return ids, results_deferreds
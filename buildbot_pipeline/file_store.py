@@ -1,7 +1,215 @@
 import os
+import re
+import gzip
+import time
+import stat
+import shutil
+import hashlib
+import sqlite3
+import threading
+
+import tarfile
+import tempfile
 
 import buildbot.data.properties as data_properties
-from twisted.web import static
+from buildbot.process import remotetransfer
+from twisted.internet import defer, threads, task
+from twisted.python import log
+from twisted.web import static, resource, http, server
+
+from buildbot_pipeline import utils
+
+BLOBS_DIR = '.blobs'
+STAGING_DIR = 'staging'
+INDEX_NAME = '.index.sqlite'
+HIDDEN_NAMES = {BLOBS_DIR, INDEX_NAME, INDEX_NAME + '-journal'}
+PRECOMPRESS_EXTS = {'.html', '.htm', '.css', '.js', '.json', '.jsonl', '.map',
+                    '.svg', '.txt', '.log', '.xml', '.csv'}
+PRECOMPRESS_MIN_SIZE = 1024
+# rebuilt inner builds rewrite the same <builder>/<pipeline_buildnumber>
+# paths, so artifacts are never immutable, a short max-age only spares
+# revalidation of pages loading many files and ETag makes it cheap anyway
+FINISHED_CACHE_CONTROL = b'public, max-age=60'
+BUILD_STATE_CACHE_SIZE = 1024
+
+HASH_RE = re.compile('[0-9a-f]{64}')
+
+_missing = object()
+
+
+def precompress(fname):
+    # writes gzipped sibling served to clients accepting gzip encoding
+    gzname = fname + '.gz'
+    with open(fname, 'rb') as src, gzip.open(gzname + '.tmp', 'wb', 6) as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+    os.replace(gzname + '.tmp', gzname)
+    return gzname
+
+
+def is_hash(value):
+    return bool(HASH_RE.fullmatch(value))
+
+
+def file_hash(fname):
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        while True:
+            data = f.read(1 << 20)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+class ArtifactIndex:
+    # Manifest of stored files, build is a path of a build storage relative
+    # to a store root (<builder>/<buildnumber>)
+    def __init__(self, fname):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(fname, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS files (
+                build TEXT NOT NULL,
+                path TEXT NOT NULL,
+                hash TEXT,
+                size INTEGER NOT NULL,
+                PRIMARY KEY (build, path))''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS files_hash ON files (hash)')
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS builds (
+                build TEXT PRIMARY KEY,
+                builder TEXT NOT NULL,
+                size INTEGER NOT NULL DEFAULT 0,
+                created REAL NOT NULL,
+                expired INTEGER NOT NULL DEFAULT 0)''')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS builds_builder ON builds (builder, created)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS builds_created ON builds (created)')
+
+            columns = {it[1] for it in self.conn.execute('PRAGMA table_info(builds)')}
+            if 'finished' not in columns:
+                self.conn.execute('ALTER TABLE builds ADD COLUMN finished INTEGER NOT NULL DEFAULT 0')
+
+    def add_files(self, build, files, removed=()):
+        # returns hashes of blobs no longer referenced after overwrites
+        with self.lock, self.conn:
+            old_hashes = set()
+            for path in [it[0] for it in files] + list(removed):
+                row = self.conn.execute('SELECT hash FROM files WHERE build = ? AND path = ?', (build, path)).fetchone()
+                if row and row[0]:
+                    old_hashes.add(row[0])
+            self.conn.executemany('DELETE FROM files WHERE build = ? AND path = ?',
+                                  [(build, path) for path in removed])
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO files (build, path, hash, size) VALUES (?, ?, ?, ?)',
+                [(build, path, h, size) for path, h, size in files])
+            self.conn.execute(
+                'INSERT OR IGNORE INTO builds (build, builder, created) VALUES (?, ?, ?)',
+                (build, os.path.dirname(build), time.time()))
+            self.conn.execute(
+                '''UPDATE builds SET expired = 0, finished = 0,
+                   size = (SELECT COALESCE(SUM(size), 0) FROM files WHERE files.build = builds.build)
+                   WHERE build = ?''', (build,))
+            return [h for h in old_hashes
+                    if not self.conn.execute('SELECT 1 FROM files WHERE hash = ? LIMIT 1', (h,)).fetchone()]
+
+    def eviction_candidates(self, keep_builds=None, max_age=None, builder_quota=None, quota=None, limit=10):
+        # returns builds violating any of retention policies, oldest first
+        cond = []
+        params = []
+        if max_age:
+            cond.append('created < ?')
+            params.append(time.time() - max_age)
+        if keep_builds:
+            cond.append('builder_idx > ?')
+            params.append(keep_builds)
+        if builder_quota:
+            cond.append('builder_total > ?')
+            params.append(builder_quota)
+        if quota:
+            cond.append('total > ?')
+            params.append(quota)
+
+        if not cond:
+            return []
+
+        q = f'''SELECT build FROM (
+                SELECT build, created,
+                    ROW_NUMBER() OVER (PARTITION BY builder ORDER BY created DESC) AS builder_idx,
+                    SUM(size) OVER (PARTITION BY builder ORDER BY created DESC) AS builder_total,
+                    SUM(size) OVER (ORDER BY created DESC) AS total
+                FROM builds WHERE expired = 0)
+               WHERE {' OR '.join(cond)}
+               ORDER BY created LIMIT ?'''
+        with self.lock:
+            return [it[0] for it in self.conn.execute(q, params + [limit])]
+
+    def expire_build(self, build):
+        # marks build as expired and returns hashes of blobs without references
+        with self.lock, self.conn:
+            hashes = [it[0] for it in self.conn.execute(
+                'SELECT DISTINCT hash FROM files WHERE build = ? AND hash IS NOT NULL', (build,))]
+            self.conn.execute('DELETE FROM files WHERE build = ?', (build,))
+            self.conn.execute('UPDATE builds SET expired = 1, size = 0 WHERE build = ?', (build,))
+            return [h for h in hashes
+                    if not self.conn.execute('SELECT 1 FROM files WHERE hash = ? LIMIT 1', (h,)).fetchone()]
+
+    def mark_finished(self, build):
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE builds SET finished = 1 WHERE build = ?', (build,))
+
+    def build_state(self, build):
+        # returns (expired, finished) or None for unknown build
+        with self.lock:
+            return self.conn.execute('SELECT expired, finished FROM builds WHERE build = ?', (build,)).fetchone()
+
+
+class StoreFileWriter(remotetransfer.FileWriter):
+    # FileWriter renames a finished temp file over a destination, so a blob
+    # shared through a hardlink is never written into
+    def __init__(self, destfile, maxsize, mode, written):
+        super().__init__(destfile, maxsize, mode)
+        self.written = written
+
+    def remote_close(self):
+        super().remote_close()
+        self.written[self.destfile] = None
+
+
+class StoreDirectoryWriter(remotetransfer.DirectoryWriter):
+    # Stock DirectoryWriter extracts into existing files in place, which
+    # would rewrite blobs shared by other builds. Archive is extracted into
+    # a staging dir and every file replaces its destination.
+    def __init__(self, destroot, maxsize, compress, mode, written):
+        super().__init__(destroot, maxsize, compress, mode)
+        self.written = written
+
+    def remote_unpack(self):
+        self.remote_close()
+
+        if self.compress == 'bz2':
+            mode = 'r|bz2'
+        elif self.compress == 'gz':
+            mode = 'r|gz'
+        else:
+            mode = 'r'
+
+        staging = ep.staging_dir()
+        try:
+            with tarfile.open(name=self.tarname, mode=mode) as archive:
+                if hasattr(tarfile, 'data_filter'):
+                    archive.extractall(path=staging, filter='data')
+                else:
+                    archive.extractall(path=staging)
+            os.remove(self.tarname)
+
+            for root, dirs, files in os.walk(staging):
+                dest = os.path.join(self.destroot, os.path.relpath(root, staging))
+                os.makedirs(dest, exist_ok=True)
+                for it in files:
+                    fname = os.path.join(dest, it)
+                    os.replace(os.path.join(root, it), fname)
+                    self.written[os.path.normpath(fname)] = None
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
 
 
 class FileStore:
@@ -9,6 +217,16 @@ class FileStore:
         self.description = 'File storage'
         self.ui = False
         self.path = None
+        self.index = None
+        self.dedupe = True
+        self.precompress = True
+        self.retention = None
+        self.retention_loop = None
+        self.register_locks = {}
+        # (expired, finished) by build, writers invalidate entries and bump
+        # generation so lookups started before a write don't cache old state
+        self.states = utils.LRUCache(BUILD_STATE_CACHE_SIZE)
+        self.states_gen = 0
 
     def setMaster(self, master):
         self.master = master
@@ -18,8 +236,289 @@ class FileStore:
         path = config['path']
         os.makedirs(path, exist_ok=True)
         self.path = path
-        self.resource = static.File(path)
+        self.dedupe = config.get('dedupe', True)
+        self.precompress = config.get('precompress', True)
+        self.index = ArtifactIndex(os.path.join(path, INDEX_NAME))
+        self.states = utils.LRUCache(BUILD_STATE_CACHE_SIZE)
+        self.resource = ArtifactFile(path)
         self.resource.contentTypes['.log'] = 'text/plain'
+        self.resource.contentTypes['.jsonl'] = 'text/plain'
+
+        # retention: {keep_builds: N, max_age: seconds, builder_quota: bytes,
+        #             quota: bytes, interval: seconds, batch: N}
+        if self.retention_loop and self.retention_loop.running:
+            self.retention_loop.stop()
+        self.retention = config.get('retention')
+        if self.retention:
+            self.retention_loop = task.LoopingCall(self.evict)
+            self.retention_loop.start(self.retention.get('interval', 600), now=False)
+
+    def blob_path(self, h):
+        if not is_hash(h):
+            raise ValueError(f'invalid blob hash: {h!r}')
+        return os.path.join(self.path, BLOBS_DIR, h[:2], h[2:])
+
+    def staging_dir(self):
+        # on the store filesystem to move extracted files without copying
+        root = os.path.join(self.path, BLOBS_DIR, STAGING_DIR)
+        os.makedirs(root, exist_ok=True)
+        return tempfile.mkdtemp(dir=root)
+
+    def link_blob(self, fname, h):
+        # replaces file with a hardlink to a blob with the same content or
+        # makes the file a new blob
+        blob = self.blob_path(h)
+        if os.path.exists(blob):
+            if not os.path.samefile(blob, fname):
+                tmpname = fname + '.bbp-link'
+                os.link(blob, tmpname)
+                os.replace(tmpname, fname)
+        else:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.link(fname, blob)
+
+    def _link_known_blobs(self, files):
+        # files: {dest: hash}, returns dests created from existing blobs
+        result = {}
+        store_root = os.path.realpath(self.path)
+        blobs_root = os.path.join(store_root, BLOBS_DIR)
+        for fname, h in files.items():
+            blob = os.path.realpath(self.blob_path(h))
+            if os.path.commonpath([blob, blobs_root]) != blobs_root:
+                raise ValueError(f'blob {h} is outside of the blob store')
+            dest = os.path.realpath(os.path.dirname(fname))
+            if (os.path.commonpath([dest, store_root]) != store_root
+                    or os.path.commonpath([dest, blobs_root]) == blobs_root):
+                raise ValueError(f'{fname} is outside of the file store')
+            tmpname = fname + '.bbp-link'
+            try:
+                os.makedirs(os.path.dirname(fname), exist_ok=True)
+                os.link(blob, tmpname)
+                os.replace(tmpname, fname)
+            except OSError:
+                continue
+            result[fname] = h
+        return result
+
+    def link_known_blobs(self, files):
+        if not self.dedupe or not self.index:
+            return defer.succeed({})
+        return threads.deferToThread(self._link_known_blobs, files)
+
+    def _register_upload(self, build_path, written):
+        build = os.path.relpath(build_path, self.path)
+        written = dict(written)
+        removed = []
+        for fname in list(written):
+            st = os.lstat(fname)
+            if (self.precompress and stat.S_ISREG(st.st_mode) and st.st_size >= PRECOMPRESS_MIN_SIZE
+                    and os.path.splitext(fname)[1].lower() in PRECOMPRESS_EXTS):
+                written[precompress(fname)] = None
+            elif fname + '.gz' not in written and os.path.exists(fname + '.gz'):
+                # sibling of an overwritten file is stale
+                os.unlink(fname + '.gz')
+                removed.append(os.path.relpath(fname + '.gz', build_path))
+
+        files = []
+        for fname, h in written.items():
+            st = os.lstat(fname)
+            if not stat.S_ISREG(st.st_mode):
+                continue
+
+            if self.dedupe and h is None:
+                h = file_hash(fname)
+                try:
+                    self.link_blob(fname, h)
+                except OSError:
+                    # filesystem without hardlinks, keep a plain copy
+                    pass
+            files.append((os.path.relpath(fname, build_path), h, st.st_size))
+
+        for h in self.index.add_files(build, files, removed):
+            try:
+                os.unlink(self.blob_path(h))
+            except FileNotFoundError:
+                pass
+
+    def register_upload(self, build_path, written):
+        # written: {fname: hash or None} of files a finished transfer created,
+        # registrations of the same build are serialized
+        if not self.index or not written:
+            return defer.succeed(None)
+
+        lock = self.register_locks.get(build_path)
+        if lock is None:
+            lock = self.register_locks[build_path] = defer.DeferredLock()
+
+        def cleanup(result):
+            self.invalidate_state(os.path.relpath(build_path, self.path))
+            if not lock.locked and not lock.waiting and self.register_locks.get(build_path) is lock:
+                del self.register_locks[build_path]
+            return result
+
+        d = lock.run(threads.deferToThread, self._register_upload, build_path, written)
+        return d.addBoth(cleanup)
+
+    def _evict(self):
+        r = self.retention
+        candidates = self.index.eviction_candidates(
+            keep_builds=r.get('keep_builds'), max_age=r.get('max_age'),
+            builder_quota=r.get('builder_quota'), quota=r.get('quota'),
+            limit=r.get('batch', 10))
+
+        for build in candidates:
+            shutil.rmtree(os.path.join(self.path, build), ignore_errors=True)
+            for h in self.index.expire_build(build):
+                try:
+                    os.unlink(self.blob_path(h))
+                except FileNotFoundError:
+                    pass
+            log.msg(f'file-store: expired artifacts of {build}')
+
+        return candidates
+
+    def evict(self):
+        # removes a batch of builds per call, so a store is cleaned up
+        # incrementally without long blocking operations
+        d = threads.deferToThread(self._evict)
+        d.addCallback(lambda builds: [self.invalidate_state(it) for it in builds])
+        d.addErrback(log.err, 'file-store eviction failed')
+        return d
+
+    def get_build_state(self, relpath):
+        # returns (expired, finished) or None for unknown build, index is
+        # queried in a thread as its lock can be held by long writers
+        parts = relpath.split('/')
+        if len(parts) < 2 or not self.index:
+            return defer.succeed(None)
+        build = '/'.join(parts[:2])
+        state = self.states.get(build, _missing)
+        if state is not _missing:
+            return defer.succeed(state)
+
+        gen = self.states_gen
+
+        def cache(state):
+            if gen == self.states_gen:
+                self.states.put(build, state)
+            return state
+
+        d = threads.deferToThread(self.index.build_state, build)
+        return d.addCallback(cache)
+
+    def invalidate_state(self, build):
+        self.states_gen += 1
+        self.states.pop(build)
+
+    def mark_finished(self, build):
+        if not self.index:
+            return defer.succeed(None)
+        d = threads.deferToThread(self.index.mark_finished, build)
+        d.addCallback(lambda _: self.invalidate_state(build))
+        d.addErrback(log.err, 'file-store: unable to mark build finished')
+        return d
+
+
+class ExpiredResource(resource.Resource):
+    isLeaf = True
+
+    def render(self, request):
+        request.setResponseCode(410)
+        request.setHeader(b'content-type', b'text/html; charset=utf-8')
+        return (b'<html><body><h1>Artifacts expired</h1>'
+                b'<p>Artifacts of this build were removed by the retention policy.</p></body></html>')
+
+
+def render_async(request, d, render):
+    # render(request, state) result is written when state is resolved,
+    # nothing is written to a closed connection
+    lost = []
+    request.notifyFinish().addErrback(lost.append)
+
+    def done(state):
+        if lost:
+            return
+        body = render(request, state)
+        if body is not server.NOT_DONE_YET:
+            request.write(body)
+            request.finish()
+
+    def failed(f):
+        log.err(f, 'file-store: unable to render artifact')
+        if not lost:
+            request.setResponseCode(500)
+            request.finish()
+
+    d.addCallback(done)
+    d.addErrback(failed)
+    return server.NOT_DONE_YET
+
+
+class MissingResource(resource.Resource):
+    # 410 for files of expired builds, 404 otherwise
+    isLeaf = True
+
+    def __init__(self, relpath, not_found):
+        super().__init__()
+        self.relpath = relpath
+        self.not_found = not_found
+
+    def render(self, request):
+        def render(request, state):
+            if state and state[0]:
+                return ExpiredResource().render(request)
+            return self.not_found.render(request)
+        return render_async(request, ep.get_build_state(self.relpath), render)
+
+
+class ArtifactFile(static.File):
+    def getChild(self, path, request):
+        if self is ep.resource and path.decode() in HIDDEN_NAMES:
+            return self.childNotFound
+
+        child = super().getChild(path, request)
+        if child is self.childNotFound:
+            relpath = os.path.relpath(os.path.join(self.path, path.decode()), ep.resource.path)
+            relpath = '/'.join([relpath] + [it.decode() for it in request.postpath])
+            return MissingResource(relpath, child)
+        return child
+
+    def render_GET(self, request):
+        self.restat(False)
+        if not self.exists() or self.isdir():
+            return super().render_GET(request)
+
+        if self.type is None:
+            self.type, self.encoding = static.getTypeAndEncoding(
+                self.basename(), self.contentTypes, self.contentEncodings, self.defaultType)
+
+        target = self
+        if self.encoding is None:
+            gz = self.siblingExtension('.gz')
+            if gz.isfile() and gz.getModificationTime() >= self.getModificationTime():
+                request.setHeader(b'vary', b'accept-encoding')
+                if b'gzip' in (request.getHeader(b'accept-encoding') or b''):
+                    target = self.createSimilarFile(gz.path)
+                    target.type, target.encoding = self.type, 'gzip'
+
+        relpath = os.path.relpath(self.path, ep.resource.path)
+        return render_async(request, ep.get_build_state(relpath),
+                            lambda request, state: self.renderFile(request, target, state))
+
+    def renderFile(self, request, target, state):
+        if state and state[1]:
+            request.setHeader(b'cache-control', FINISHED_CACHE_CONTROL)
+        else:
+            request.setHeader(b'cache-control', b'no-cache')
+
+        target.restat(False)
+        etag = f'"{target.getInodeNumber():x}-{target.getsize():x}-{int(target.getModificationTime()):x}"'
+        if request.setETag(etag.encode()) is http.CACHED:
+            return b''
+
+        return static.File.render_GET(target, request)
+
+    render_HEAD = render_GET
 
 
 ep = FileStore()
@@ -1,6 +1,8 @@
 import re
+import bisect
 import fnmatch
 import operator
+import functools
 
 from .utils import ensure_list
 
@@ -35,8 +37,86 @@ def filter_match(val, getter):
         return lambda value: getter(value) == val
 
 
+@functools.lru_cache(1000)
+def compile_fnmatch(pattern):
+    return re.compile(fnmatch.translate(pattern)).match
+
+
+WILDCARD_RE = re.compile(r'[*?[]')
+
+
+class FilesIndex:
+    # Sorted file list allows to check only files sharing literal prefix with
+    # a pattern. Results are memoized, so patterns shared by many pipelines
+    # are evaluated once per change.
+    def __init__(self, files):
+        self.files = files
+        self.sorted_files = sorted(files)
+        self.matches = {}
+
+    def match(self, pattern):
+        try:
+            return self.matches[pattern]
+        except KeyError:
+            pass
+
+        m = WILDCARD_RE.search(pattern)
+        prefix = pattern[:m.start()] if m else pattern
+        match = compile_fnmatch(pattern)
+        files = self.sorted_files
+        result = False
+        for idx in range(bisect.bisect_left(files, prefix), len(files)):
+            fname = files[idx]
+            if not fname.startswith(prefix):
+                break
+            if match(fname):
+                result = True
+                break
+
+        self.matches[pattern] = result
+        return result
+
+    def select(self, pattern):
+        # all files matching a pattern
+        m = WILDCARD_RE.search(pattern)
+        prefix = pattern[:m.start()] if m else pattern
+        match = compile_fnmatch(pattern)
+        files = self.sorted_files
+        result = []
+        for idx in range(bisect.bisect_left(files, prefix), len(files)):
+            fname = files[idx]
+            if not fname.startswith(prefix):
+                break
+            if match(fname):
+                result.append(fname)
+        return result
+
+
+def files_index(value):
+    idx = getattr(value, '_bbp_files_index', None)
+    if idx is None or idx.files is not value.files:
+        idx = value._bbp_files_index = FilesIndex(value.files)
+    return idx
+
+
+def file_patterns(filters):
+    # every file pattern mentioned in a filter description, including
+    # negated and alternative ones
+    if hasattr(filters, 'keys'):
+        filters = [filters]
+
+    result = []
+    for desc in filters:
+        for name, values in desc.items():
+            if name in ('file', 'files'):
+                result.extend(ensure_list(values))
+            elif name in ('not', 'or'):
+                result.extend(file_patterns(values))
+    return result
+
+
 def filter_fnmatch(pattern, getter):
-    return lambda value: bool(fnmatch.filter(getter(value), pattern))
+    return lambda value: getter(value).match(pattern)
 
 
 def make_filter(values, flt_fn, getter):
@@ -59,8 +139,8 @@ FILTERS = {
     'branches': (filter_match, operator.attrgetter('branch')),
     'comment': (filter_match, operator.attrgetter('comments')),
     'comments': (filter_match, operator.attrgetter('comments')),
-    'file': (filter_fnmatch, operator.attrgetter('files')),
-    'files': (filter_fnmatch, operator.attrgetter('files')),
+    'file': (filter_fnmatch, files_index),
+    'files': (filter_fnmatch, files_index),
     'status': (filter_match, update_type_getter),
     'tag': (filter_match, lambda value: value.props.getProperty('event.change.tag')),
 }
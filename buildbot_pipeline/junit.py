@@ -1,3 +1,4 @@
+import json
 import functools
 from xml.etree import ElementTree as ET
 
@@ -44,39 +45,167 @@ test_t = xml_schema(
     failure=opt(error_t, src='failure'),
     name=item(xml_attr('name'), src='.'),
     classname=item(xml_attr('classname'), src='.'),
+    file=opt(xml_attr('file'), src='.'),
     time=item(xml_attr('time'), src='.') | float,
     stdout=opt(xml_text, src='system-out'),
     stderr=opt(xml_text, src='system-err'),
     properties=item(property_t, src='properties/property', multi=True),
 )
 
-testsuite_t = xml_schema(
-    name=item(xml_attr('name'), src='.'),
-    package=item(xml_attr('package'), src='.'),
-    testcases=item(test_t, src=('testcase'), multi=True),
-    tests=item(xml_attr('tests'), src='.') | int,
-    errors=item(xml_attr('errors'), src='.') | int,
-    failures=item(xml_attr('failures'), src='.') | int,
-    skipped=opt(xml_attr('skipped'), src='.', default=0),
-    skips=opt(xml_attr('skips'), src='.', default=0),
-    time=item(xml_attr('time'), src='.') | float,
-)
-
-
-junit_single_t = xml_schema(suites=item(testsuite_t, multi=True, src='.'))
-junit_many_t = xml_schema(suites=item(testsuite_t, multi=True, src='testsuite'))
+# passed test cases kept for a report, others are only counted
+KEEP_PASSED = 1000
+READ_BLOCKSIZE = 1 << 16
+
+
+def attr_num(elem, name, cnv, default):
+    try:
+        return cnv(elem.attrib[name])
+    except (KeyError, ValueError):
+        return default
+
+
+def case_unit(suite, case):
+    # the smallest thing a test runner can be asked to run, used to
+    # collect timings for sharding
+    return case['file'] or case['classname'] or suite['name']
+
+
+def case_status(case):
+    if case['error']:
+        return 'error'
+    elif case['failure']:
+        return 'fail'
+    return 'ok'
+
+
+# Writes every test case as a compact json line
+class JSONLinesSink:
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.count = 0
+
+    def __call__(self, suite, case):
+        fail = case['error'] or case['failure'] or {}
+        rec = {
+            'suite': suite['name'],
+            'classname': case['classname'],
+            'name': case['name'],
+            'time': case['time'],
+            'status': case_status(case),
+        }
+        for k, v in (('message', fail.get('message')), ('content', fail.get('content')),
+                     ('stdout', case['stdout']), ('stderr', case['stderr'])):
+            if v and v.strip():
+                rec[k] = v
+        self.fileobj.write(json.dumps(rec, separators=(',', ':')).encode() + b'\n')
+        self.count += 1
+
+
+# Incremental parser, accepts data chunks via feed() and keeps only suite
+# aggregates, failed test cases and first `keep_passed` passed cases (all if
+# None). Optional sink is called for every test case.
+class JUnitParser:
+    def __init__(self, keep_passed=KEEP_PASSED, sink=None):
+        self.keep_passed = keep_passed
+        self.sink = sink
+        self.suites = []
+        self.error = None
+        self.passed = 0
+        self.timings = {}
+        self._parser = ET.XMLPullParser(events=('start', 'end'))
+        self._elems = []
+        self._suites = []
+
+    def feed(self, data):
+        if self.error is not None:
+            return
+        try:
+            self._parser.feed(data)
+            self._process()
+        except Exception as e:
+            self.error = e
+
+    def close(self):
+        if self.error is None:
+            try:
+                self._parser.close()
+                self._process()
+            except Exception as e:
+                self.error = e
+        return self.suites
+
+    def _process(self):
+        for event, elem in self._parser.read_events():
+            if event == 'start':
+                if elem.tag == 'testsuite':
+                    self._start_suite(elem)
+                self._elems.append(elem)
+                continue
+
+            self._elems.pop()
+            if elem.tag == 'testcase':
+                if self._suites:
+                    self._add_case(self._suites[-1], test_t(elem))
+            elif elem.tag == 'testsuite':
+                self._suites.pop()
+            else:
+                continue
+
+            # processed elements are not needed anymore
+            if self._elems:
+                self._elems[-1].remove(elem)
+            elem.clear()
+
+    def _start_suite(self, elem):
+        suite = {
+            'name': elem.attrib.get('name'),
+            'package': elem.attrib.get('package'),
+            'testcases': [],
+            'tests': attr_num(elem, 'tests', int, 0),
+            'errors': attr_num(elem, 'errors', int, 0),
+            'failures': attr_num(elem, 'failures', int, 0),
+            'skipped': attr_num(elem, 'skipped', int, 0),
+            'skips': attr_num(elem, 'skips', int, 0),
+            'time': attr_num(elem, 'time', float, 0.0),
+            'omitted': 0,
+        }
+        self.suites.append(suite)
+        self._suites.append(suite)
+
+    def _add_case(self, suite, case):
+        if self.sink:
+            self.sink(suite, case)
+
+        unit = case_unit(suite, case)
+        if unit:
+            self.timings[unit] = self.timings.get(unit, 0.0) + (case['time'] or 0.0)
+
+        if not (case['error'] or case['failure']):
+            if self.keep_passed is not None and self.passed >= self.keep_passed:
+                suite['omitted'] += 1
+                return
+            self.passed += 1
+        suite['testcases'].append(case)
+
+
+def parse(fname, keep_passed=None):
+    parser = JUnitParser(keep_passed)
+    if hasattr(fname, 'read'):
+        f = fname
+    else:
+        f = open(fname, 'rb')
 
+    with f:
+        while True:
+            data = f.read(READ_BLOCKSIZE)
+            if not data:
+                break
+            parser.feed(data)
 
-def parse(fname):
-    root = ET.parse(fname)
-    root_tag = root.getroot().tag
-    if root_tag == 'testsuite':
-        s = junit_single_t
-    elif root_tag == 'testsuites':
-        s = junit_many_t
-    else:
-        return []
-    return s(root)['suites']
+    suites = parser.close()
+    if parser.error is not None:
+        raise parser.error
+    return suites
 
 
 EMBED_TEMPLATE = '''\
@@ -99,6 +228,12 @@ EMBED_TEMPLATE = '''\
   <div class="bb-pipe-junit-suite">
     <h2>{{ suite.name }}</h2>
     <p>Total: {{ suite.tests }}, errors: {{ suite.errors }}, failures: {{ suite.failures }}, skipped: {{ suite.skipped }}. Time: {{ suite.time }}</p>
+    {% if suite.omitted %}
+    <p>{{ suite.omitted }} passed test cases are not shown.</p>
+    {% endif %}
+    {% if full_report_url %}
+    <p><a href="{{ full_report_url }}" target="_blank">All test cases</a> (JSON lines).</p>
+    {% endif %}
     {% for case in suite.testcases %}
     <div class="bb-pipe-junit-case" style="margin-bottom: 0.5em;">
       <details {%if case.fail %}open{% endif %}>
@@ -144,18 +279,12 @@ def get_template(embed):
     return Template(HTML_TEMPLATE, **params)
 
 
-def gen_html(suites, embed=False):
+def gen_html(suites, embed=False, full_report_url=None):
     for s in suites:
         s['skipped'] = s['skipped'] or s['skips']
         for c in s['testcases']:
             c['fail'] = c['error'] or c['failure']
-
-            if c['error']:
-                c['status'] = 'error'
-            elif c['failure']:
-                c['status'] = 'fail'
-            else:
-                c['status'] = 'ok'
+            c['status'] = case_status(c)
 
             if c['stderr'] and not c['stderr'].strip():
                 c['stderr'] = None
@@ -164,7 +293,7 @@ def gen_html(suites, embed=False):
 
         s['testcases'].sort(key=lambda it: not it['fail'])
 
-    return get_template(embed).render(suites=suites)
+    return get_template(embed).render(suites=suites, full_report_url=full_report_url)
 
 
 def main():
@@ -0,0 +1,139 @@
+import os
+import re
+import hashlib
+
+from twisted.internet import defer, reactor
+from buildbot.util import runprocess
+
+MIRRORS_DIR = 'pipeline_mirrors'
+FETCHED_REF = 'refs/pipeline/fetched'
+
+_mirrors = {}
+
+
+class GitError(Exception):
+    pass
+
+
+def parse_batch(data):
+    result = {}
+    pos = 0
+    while pos < len(data):
+        eol = data.index(b'\n', pos)
+        header = data[pos:eol].split()
+        pos = eol + 1
+        if header[-1] == b'missing':
+            continue
+        size = int(header[2])
+        result[header[0].decode()] = data[pos:pos + size]
+        pos += size + 1
+    return result
+
+
+def parse_ls_tree(data, ext=None):
+    # parses `git ls-tree -r -z` output into [(path, sha)] of blobs
+    if isinstance(data, bytes):
+        data = data.decode()
+    result = []
+    for line in data.split('\0'):
+        if not line:
+            continue
+        info, _, fname = line.partition('\t')
+        _, otype, sha = info.split()
+        if otype == 'blob' and (ext is None or fname.endswith(ext)):
+            result.append((fname, sha))
+    return result
+
+
+class GitMirror:
+    def __init__(self, path, repourl):
+        self.path = path
+        self.repourl = repourl
+        self.lock = defer.DeferredLock()
+
+    @defer.inlineCallbacks
+    def git(self, *args, stdin=None):
+        rc, stdout, stderr = yield runprocess.run_process(
+            reactor, ['git', *args], workdir=self.path, initial_stdin=stdin)
+        if rc != 0:
+            raise GitError(f'git {args[0]} failed for {self.repourl}: {stderr.decode(errors="replace").strip()}')
+        return stdout
+
+    @defer.inlineCallbacks
+    def has_commit(self, revision):
+        try:
+            yield self.git('cat-file', '-e', f'{revision}^{{commit}}')
+        except GitError:
+            return False
+        return True
+
+    @defer.inlineCallbacks
+    def _update(self, branch):
+        if not os.path.exists(os.path.join(self.path, 'HEAD')):
+            os.makedirs(self.path, exist_ok=True)
+            yield self.git('init', '--quiet', '--bare')
+            yield self.git('remote', 'add', 'origin', self.repourl)
+
+        refspecs = ['+refs/heads/*:refs/heads/*']
+        if branch and branch.startswith('refs/') and not branch.startswith('refs/heads/'):
+            # gerrit changes and other refs outside of heads
+            refspecs.append(f'+{branch}:{FETCHED_REF}')
+        yield self.git('fetch', '--quiet', '--prune', '--no-tags', 'origin', *refspecs)
+
+    @defer.inlineCallbacks
+    def _resolve(self, revision, branch):
+        if revision and (yield self.has_commit(revision)):
+            return revision
+
+        yield self._update(branch)
+
+        if revision:
+            if not (yield self.has_commit(revision)):
+                yield self.git('fetch', '--quiet', '--no-tags', 'origin', revision)
+            return revision
+
+        if not branch:
+            raise GitError(f'Revision or branch is required to resolve {self.repourl}')
+
+        if branch.startswith('refs/') and not branch.startswith('refs/heads/'):
+            ref = FETCHED_REF
+        elif branch.startswith('refs/heads/'):
+            ref = branch
+        else:
+            ref = 'refs/heads/' + branch
+
+        rv = yield self.git('rev-parse', '--verify', ref + '^{commit}')
+        return rv.decode().strip()
+
+    # returns commit for revision or a branch head, fetches from origin if needed
+    def resolve(self, revision, branch):
+        return self.lock.run(self._resolve, revision, branch)
+
+    @defer.inlineCallbacks
+    def list_files(self, revision, path, ext='.yaml'):
+        rv = yield self.git('ls-tree', '-r', '-z', revision, '--', path.rstrip('/') + '/')
+        return parse_ls_tree(rv, ext)
+
+    @defer.inlineCallbacks
+    def list_tree(self, revision):
+        rv = yield self.git('ls-tree', '-r', '-z', revision)
+        return parse_ls_tree(rv)
+
+    @defer.inlineCallbacks
+    def read_blobs(self, shas):
+        if not shas:
+            return {}
+        rv = yield self.git('cat-file', '--batch', stdin=''.join(f'{it}\n' for it in shas).encode())
+        return parse_batch(rv)
+
+
+def get_mirror(basedir, repourl):
+    try:
+        return _mirrors[repourl]
+    except KeyError:
+        pass
+
+    name = re.sub(r'[^\w.-]+', '_', repourl.rpartition('/')[2] or 'repo')
+    name += '-' + hashlib.sha1(repourl.encode()).hexdigest()[:10]
+    m = _mirrors[repourl] = GitMirror(os.path.join(basedir, MIRRORS_DIR, name), repourl)
+    return m
@@ -96,9 +96,9 @@ def get(orig, self, resultSpec, kwargs):
         builds = yield self.master.db.builds.getBuildsForChange(changeid)
     elif b'relatedfor' in orig_req_args:
         buildid = int(nstr(orig_req_args[b'relatedfor'][0]))
-        bpath = (yield bpp_build.get_bpath(self.master, buildid)) or [buildid]
-        builds = yield bpp_build.get_child_builds(self.master, bpath[:1])
-        root_build = yield self.master.db.builds.getBuild(bpath[0])
+        root_buildid = (yield bpp_build.get_build_root(self.master, buildid)) or buildid
+        builds = yield bpp_build.get_child_builds(self.master, root_buildid)
+        root_build = yield self.master.db.builds.getBuild(root_buildid)
         if root_build:
             builds.append(root_build)
     else:
@@ -0,0 +1,88 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+
+from twisted.internet import threads
+
+CACHE_DIR = 'step_cache'
+META_NAME = 'meta.json'
+ARCHIVE_NAME = 'outputs.tar.gz'
+# bump to invalidate all entries after changing what a key covers
+KEY_VERSION = 2
+MAX_AGE = 7 * 86400
+PRUNE_INTERVAL = 3600
+
+_last_prune = {}
+
+
+def make_key(command, env, inputs, extra):
+    data = json.dumps({'version': KEY_VERSION, 'command': command, 'env': env,
+                       'inputs': inputs, 'extra': extra}, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def entry_path(basedir, key):
+    return os.path.join(basedir, CACHE_DIR, key[:2], key)
+
+
+def _load(basedir, key):
+    path = entry_path(basedir, key)
+    try:
+        with open(os.path.join(path, META_NAME)) as f:
+            meta = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None, None
+
+    # keeps used entries from pruning
+    os.utime(os.path.join(path, META_NAME))
+    archive = os.path.join(path, ARCHIVE_NAME)
+    return meta, archive if os.path.exists(archive) else None
+
+
+def _store(basedir, key, meta, archive):
+    path = entry_path(basedir, key)
+    tmppath = path + f'.tmp-{os.getpid()}-{time.monotonic_ns()}'
+    os.makedirs(tmppath)
+    try:
+        if archive:
+            os.replace(archive, os.path.join(tmppath, ARCHIVE_NAME))
+        with open(os.path.join(tmppath, META_NAME), 'w') as f:
+            json.dump(meta, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmppath, path)
+    except Exception:
+        shutil.rmtree(tmppath, ignore_errors=True)
+        raise
+    _prune(basedir)
+
+
+def _prune(basedir):
+    now = time.time()
+    if now - _last_prune.get(basedir, 0) < PRUNE_INTERVAL:
+        return
+    _last_prune[basedir] = now
+
+    root = os.path.join(basedir, CACHE_DIR)
+    for bucket in os.scandir(root):
+        if not bucket.is_dir():
+            # archive uploads left by a restarted master
+            if bucket.name.endswith('.upload') and now - bucket.stat().st_mtime > PRUNE_INTERVAL:
+                os.unlink(bucket.path)
+            continue
+        for entry in os.scandir(bucket.path):
+            try:
+                mtime = os.stat(os.path.join(entry.path, META_NAME)).st_mtime
+            except FileNotFoundError:
+                mtime = entry.stat().st_mtime
+            if now - mtime > MAX_AGE:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def load(basedir, key):
+    return threads.deferToThread(_load, basedir, key)
+
+
+def store(basedir, key, meta, archive):
+    return threads.deferToThread(_store, basedir, key, meta, archive)
@@ -1,23 +1,45 @@
 import os.path
+import copy
+import hashlib
 import itertools
 import json
 import yaml
 import shlex
 import re
+import tarfile
+import tempfile
 from pathlib import Path
 
-from buildbot.process import buildstep, logobserver, results, properties
-from buildbot.steps.transfer import MultipleFileUpload
+from buildbot.process import buildstep, logobserver, results, properties, remotetransfer
+from buildbot.steps.transfer import MultipleFileUpload, makeStatusRemoteCommand
 from buildbot.steps.trigger import Trigger
 from buildbot.steps.source import git
+from buildbot.util import runprocess
 
-from twisted.internet import defer
+from buildbot.reporters.utils import getURLForBuildrequest
+
+from twisted.internet import defer, reactor
+from twisted.python import log
 from twisted.python.failure import Failure
 
-from buildbot_pipeline import junit, utils, filters, file_store, build, schedulers as bbp_schedulers
+from buildbot_pipeline import junit, utils, filters, file_store, build, mirror, buildsets, timings, step_cache, schedulers as bbp_schedulers
 
 DEFAULT_STEPSDIR = 'buildbot'
 HIDDEN = 'hidden'
+PIPELINE_ARCHIVE_MAXSIZE = 16 << 20
+GATHER_CONCURRENCY = 8
+MARKUP_MAX_LINE_LENGTH = 1 << 24
+JUNIT_MAXSIZE = 512 << 20
+# summary: only failed test cases are rendered inline, full: up to
+# junit.KEEP_PASSED passed cases are rendered too
+JUNIT_REPORT_MODE = 'full'
+TRANSFER_CONCURRENCY = 4
+# directories are packed on a worker, compressed and unpacked on master
+UPLOAD_COMPRESS = 'gz'
+STEP_CACHE_MAXSIZE = 1 << 30
+# set by gen_steps for every shell step, they differ between builds and are
+# not a part of a step cache key
+BUILD_ENV_NAMES = ('BUILD_ID', 'WORKSPACE', 'BUILD_STATUS')
 
 
 def process_interpolate(value):
@@ -61,6 +83,82 @@ def normalize_pipeline(pipeline):
     return pipeline
 
 
+def git_blob_hash(content):
+    return hashlib.sha1(b'blob %d\0' % len(content) + content).hexdigest()
+
+
+class PipelineEntry:
+    def __init__(self, data):
+        self.data = normalize_pipeline(data)
+        self._filter = None
+
+    def pipeline(self):
+        return copy.deepcopy(self.data)
+
+    def get_filter(self):
+        if self._filter is None:
+            try:
+                flt_desc = copy.deepcopy(self.data['filter'])
+                if 'status' not in flt_desc:
+                    flt_desc['status'] = 'new'
+                self._filter = filters.make_filters(flt_desc), None
+            except Exception as e:
+                self._filter = None, str(e)
+
+        flt, error = self._filter
+        if error is not None:
+            raise Exception(error)
+        return flt
+
+
+# parsed pipelines keyed by git blob hash of a file content,
+# distributor builds mostly see the same files over and over again
+pipeline_cache = utils.LRUCache(1000)
+
+
+def load_pipeline(content):
+    key = git_blob_hash(content)
+    entry = pipeline_cache.get(key)
+    if entry is None:
+        entry = PipelineEntry(yaml.safe_load(content))
+        pipeline_cache.put(key, entry)
+    return entry
+
+
+# parallel children share most of their definition (matrix cells differ
+# only in name and properties), shared part is stored once by its hash in
+# bbpipe_steps_info and children get a reference to it, refs created before
+# it are <buildid>:<hash> and point to build_data of a triggering build
+STEPS_DATA_PREFIX = 'steps:'
+STEPS_INFO_OWN_KEYS = ('name', 'properties')
+steps_info_cache = utils.LRUCache(256)
+
+
+def split_steps_info(info):
+    own = {k: info[k] for k in STEPS_INFO_OWN_KEYS if k in info}
+    shared = json.dumps({k: v for k, v in info.items() if k not in own}, sort_keys=True).encode()
+    return own, shared
+
+
+@defer.inlineCallbacks
+def load_steps_info(master, ref, own):
+    buildid, _, h = ref.rpartition(':')
+    shared = steps_info_cache.get(h)
+    if shared is None:
+        data = yield build.get_steps_info(master, h)
+        if data is None and buildid:
+            data = yield master.db.build_data.getBuildData(int(buildid), STEPS_DATA_PREFIX + h)
+            data = data and data['value']
+        if data is None:
+            raise Exception(f'Steps definition {ref} is not found')
+        shared = json.loads(data)
+        steps_info_cache.put(h, shared)
+
+    result = copy.deepcopy(shared)
+    result.update(own)
+    return result
+
+
 def gen_steps(step, data):
     if type(data) is list:
         return [gen_steps(step, it) for it in data]
@@ -133,7 +231,15 @@ def gen_steps(step, data):
             info = {'steps': info}
 
         matrix = info.pop('matrix', None)
+        shard = info.pop('shard', None)
         steps = info.pop('steps', [])
+        for it in (matrix, shard):
+            # pmatrix has no parallel block to put options into
+            for opt in ('fail_fast', 'max_parallel'):
+                if it and opt in it:
+                    info.setdefault(opt, it.pop(opt))
+        if shard:
+            steps.insert(0, {'shard': shard})
         if matrix:
             steps.insert(0, {'matrix': matrix})
 
@@ -170,6 +276,27 @@ def matrix_steps(steps):
                         s['properties']['skip_passed'] = skip_passed
                     s['name'] = name.format(**props) if name else '-'.join(map(str, pvals))
                     yield s
+        elif 'shard' in info:
+            # files are assigned to shards at trigger time, see Parallel.assign_shards
+            step_desc = info['shard']
+            name = step_desc.pop('name', 'shard-{index}')
+            count = int(step_desc.pop('count', 2))
+            skip_passed = step_desc.pop('skip_passed', None)
+            shard = {
+                'key': step_desc.pop('key', name),
+                'files': step_desc.pop('files', None),
+                'items': step_desc.pop('items', None),
+                'count': count,
+            }
+            for i in range(count):
+                s = step_desc.copy()
+                s['properties'] = s.get('properties', {}).copy()
+                s['properties'].update(shard_index=i + 1, shard_count=count)
+                if skip_passed is not None:
+                    s['properties']['skip_passed'] = skip_passed
+                s['name'] = name.format(index=i + 1, count=count)
+                s['shard'] = shard
+                yield s
         else:
             yield info
 
@@ -183,12 +310,17 @@ def build_results(props):
 
 
 class Parallel(Trigger):
-    def __init__(self, steps_info, inner=True, **kwargs):
+    def __init__(self, steps_info, inner=True, fail_fast=False, max_parallel=None, **kwargs):
         kwargs.setdefault('waitForFinish', True)
         super().__init__('trig-prop-builder', **kwargs)
         self.steps_info = steps_info
         self.correct_names = [it['name'] for it in steps_info]
         self.inner = inner
+        self.fail_fast = fail_fast
+        self.max_parallel = max_parallel
+        self.queued = []
+        self.pending_brids = {}
+        self.cancelled_brids = []
 
     def getAllGotRevisions(self):
         # annotated tags can skew revision so we need to get original revision
@@ -207,12 +339,19 @@ class Parallel(Trigger):
             workdir = self.getProperty('wc')
             root_buildnumber = self.getProperty('pipeline_buildnumber') or self.getProperty('buildnumber')
 
+        steps_info = yield self.assign_shards()
+
         result = []
-        for it in self.steps_info:
+        shared_infos = {}
+        for it in steps_info:
+            own, shared = split_steps_info(it)
+            h = git_blob_hash(shared)
+            shared_infos[h] = shared
             s = {
                 'sched_name': 'trig-prop-builder',
                 'props_to_set': {
-                    'steps_info': json.dumps(it),
+                    'steps_info_ref': h,
+                    'steps_info_own': json.dumps(own),
                 },
                 'unimportant': False
             }
@@ -245,8 +384,141 @@ class Parallel(Trigger):
                 )
 
             result.append(s)
+
+        for h, shared in shared_infos.items():
+            yield build.add_steps_info(self.master, h, shared.decode())
+        return result
+
+    @defer.inlineCallbacks
+    def assign_shards(self):
+        # splits files (or items) between shard children by durations
+        # collected from junit reports of previous runs
+        owner = self.getProperty('virtual_builder_name') or self.getProperty('buildername')
+        assigned = {}
+        result = []
+        for it in self.steps_info:
+            shard = it.get('shard')
+            if not shard:
+                result.append(it)
+                continue
+
+            key = f'{owner}:{shard["key"]}'
+            if id(shard) not in assigned:
+                items = shard['items']
+                if items is None:
+                    items = yield utils.glob_files(self, shard['files'], self.getProperty('wc'))
+                weights = timings.file_weights((yield timings.get(self.master, key)))
+                assigned[id(shard)] = iter(timings.balance(utils.ensure_list(items), weights, shard['count']))
+
+            it = {k: v for k, v in it.items() if k != 'shard'}
+            it['properties'] = dict(it['properties'], shard_key=key, shard_files=next(assigned[id(shard)]))
+            result.append(it)
+        return result
+
+    # same as Trigger.run, but children are created with bulk inserts
+    # instead of a scheduler call per child
+    @defer.inlineCallbacks
+    def run(self):
+        entries = yield self.getSchedulersAndProperties()
+        sch = self.getSchedulerByName('trig-prop-builder')
+        props_list = [self.createTriggerProperties(it['props_to_set']) for it in entries]
+
+        # max_parallel: children over the limit are queued here and
+        # triggered as running ones finish
+        limit = len(props_list)
+        if self.max_parallel and self.waitForFinish:
+            limit = max(1, int(self.max_parallel))
+        self.queued = list(enumerate(props_list))
+        self.slots = [defer.Deferred() for _ in props_list]
+
+        self.running = True
+        result = results.SUCCESS
+        yield self.triggerChildren(sch, limit)
+        self.triggeredNames = [sch.name] * len(props_list)
+        if self.ended:
+            return results.CANCELLED
+
+        if self.waitForFinish:
+            self.waitForFinishDeferred = defer.DeferredList(self.slots, consumeErrors=1)
+            try:
+                rclist = yield self.waitForFinishDeferred
+            except defer.CancelledError:
+                pass
+            if self.ended:
+                return results.CANCELLED
+            yield self.addBuildUrls(rclist)
+            # siblings cancelled by fail_fast don't affect the result
+            result = yield self.worstStatus(result, rclist, self.cancelled_brids)
+        else:
+            for d in self.slots:
+                d.addErrback(log.err, '(ignored) while invoking Triggerable schedulers:')
+
         return result
 
+    @defer.inlineCallbacks
+    def triggerChildren(self, sch, count):
+        batch, self.queued = self.queued[:count], self.queued[count:]
+        if not batch:
+            return
+
+        try:
+            ids, dl = yield buildsets.trigger_many(
+                sch, [it for _, it in batch], waited_for=self.waitForFinish,
+                sourcestamps=self.prepareSourcestampListForTrigger(),
+                parent_buildid=self.build.buildid,
+                parent_relationship=self.parent_relationship)
+        except Exception:
+            f = Failure()
+            for i, _ in batch:
+                self.slots[i].errback(f)
+            # queued children are triggered only when running ones finish,
+            # without cancelling the step would wait for them forever
+            self.cancelQueued()
+            return
+
+        for (i, _), (bsid, brids), d in zip(batch, ids, dl):
+            if self.fail_fast and self.waitForFinish:
+                self.pending_brids[bsid] = list(brids.values())
+                d.addCallback(self.checkFailFast, bsid)
+            d.addBoth(self.childFinished, sch)
+            d.chainDeferred(self.slots[i])
+
+        for _, brids in ids:
+            self.brids.extend(brids.values())
+            for brid in brids.values():
+                url = getURLForBuildrequest(self.master, brid)
+                yield self.addURL(f'{sch.name} #{brid}', url)
+                self._add_results(brid)
+
+    def childFinished(self, rv, sch):
+        if self.queued and not self.ended:
+            d = self.triggerChildren(sch, 1)
+            d.addErrback(log.err, 'unable to trigger queued child')
+        return rv
+
+    def cancelQueued(self):
+        queued, self.queued = self.queued, []
+        for i, _ in queued:
+            self.slots[i].callback((results.CANCELLED, {}))
+
+    def interrupt(self, reason):
+        self.cancelQueued()
+        return super().interrupt(reason)
+
+    def checkFailFast(self, rv, bsid):
+        self.pending_brids.pop(bsid, None)
+        if rv[0] in (results.FAILURE, results.EXCEPTION) and self.pending_brids:
+            # cancels pending requests and stops running builds
+            for brids in self.pending_brids.values():
+                for brid in brids:
+                    d = self.master.data.control(
+                        'cancel', {'reason': 'sibling build failed (fail_fast)'}, ('buildrequests', brid))
+                    d.addErrback(log.err, f'unable to cancel build request {brid}')
+                self.cancelled_brids.extend(brids)
+            self.pending_brids = {}
+            self.cancelQueued()
+        return rv
+
     def getCurrentSummary(self):
         if self.triggeredNames:
             self.triggeredNames = self.correct_names
@@ -266,20 +538,45 @@ class PropStep(buildstep.BuildStep):
             self.build.results = results.SKIPPED
             return True
 
+    @defer.inlineCallbacks
+    def checkUnchanged(self, input_hash):
+        name = self.getProperty('virtual_builder_name')
+        prev = yield build.get_build_by_input_hash(self.master, name, input_hash)
+        if prev:
+            self.addURL('Build with the same inputs', f'#/builders/{prev.builderid}/builds/{prev.number}')
+            self.descriptionDone = ['Inputs are unchanged']
+            self.build.results = results.SKIPPED
+            return True
+
     @defer.inlineCallbacks
     def run(self):
-        steps_info = json.loads(self.getProperty('steps_info', '{}'))
+        ref = self.getProperty('steps_info_ref')
+        if ref:
+            own = json.loads(self.getProperty('steps_info_own', '{}'))
+            steps_info = yield load_steps_info(self.master, ref, own)
+        else:
+            steps_info = json.loads(self.getProperty('steps_info', '{}'))
 
         if utils.to_bool(self.getProperty('skip_passed')):
             already_passed = yield self.checkAlreadyPassed()
             if already_passed:
                 return results.SKIPPED
 
+        input_hash = self.getProperty('pipeline_input_hash')
+        if input_hash:
+            unchanged = yield self.checkUnchanged(input_hash)
+            if unchanged:
+                return results.SKIPPED
+
         # TODO: move env handling to gen_steps
         self.build.pipeline_env = {}
         if type(steps_info) is dict:
             self.build.pipeline_env = steps_info.get('env', {})
 
+        shard_files = self.getProperty('shard_files')
+        if shard_files is not None:
+            self.build.pipeline_env['SHARD_FILES'] = ' '.join(shard_files)
+
         self.build.addStepsAfterCurrentStep(utils.ensure_list(gen_steps(self, steps_info)))
         return results.SUCCESS
 
@@ -292,10 +589,67 @@ class GatherBuilders(buildstep.BuildStep):
         self.pipeline_build_props = kwargs.pop('build_props', None)
         self.wait_for_finish = kwargs.pop('wait_for_finish', False)
         self.is_local = kwargs.pop('local', True)
+        self.is_mirror = kwargs.pop('mirror', False)
+        self.bulk_fetch = kwargs.pop('bulk_fetch', True)
+        self.pipeline_contents = {}
+        self.tree_index = None
+        self.tree_lock = defer.DeferredLock()
         super().__init__(**kwargs)
 
+    @defer.inlineCallbacks
+    def fetch_pipeline_archive(self, buildbot_path):
+        # fetch whole stepsdir in a single transfer, returns None
+        # if worker can't do it and caller should fallback to per-file fetching
+        if self.workerVersionIsOlderThan('uploadDirectory', '3.0'):
+            return None
+
+        writer = utils.ArchiveWriter()
+        try:
+            rv = yield utils.silent_remote_command(
+                self, 'uploadDirectory', workdir='/', workersrc=str(buildbot_path), writer=writer,
+                blocksize=1 << 16, maxsize=PIPELINE_ARCHIVE_MAXSIZE, compress='gz')
+            if rv.rc != results.SUCCESS:
+                return None
+
+            writer.buf.seek(0)
+            result = {}
+            with tarfile.open(fileobj=writer.buf, mode='r|gz') as archive:
+                for member in archive:
+                    if member.isfile() and member.name.endswith('.yaml'):
+                        result[str(buildbot_path / member.name)] = archive.extractfile(member).read()
+            return result
+        except tarfile.TarError:
+            return None
+        finally:
+            writer.buf.close()
+
+    @defer.inlineCallbacks
+    def list_mirror_pipeline_files(self):
+        # reads pipelines from a master-side bare mirror without any checkout
+        stepsdir = self.getProperty('pipeline_stepsdir', DEFAULT_STEPSDIR).strip('/')
+        m = mirror.get_mirror(self.master.basedir, self.getProperty('repository'))
+        revision = yield m.resolve(self.getProperty('revision'), self.getProperty('branch'))
+        if not self.getProperty('revision'):
+            self.setProperty('revision', revision, 'Build')
+        self.setProperty('got_revision', revision, 'Build')
+
+        files = yield m.list_files(revision, stepsdir)
+        blobs = yield m.read_blobs(sorted({sha for _, sha in files}))
+
+        result = []
+        for repopath, sha in files:
+            fullpath = f'{revision}:{repopath}'
+            name, _, _ = repopath[len(stepsdir) + 1:].rpartition('.')
+            self.pipeline_contents[fullpath] = blobs[sha]
+            result.append((name, fullpath, repopath))
+        return result
+
     @defer.inlineCallbacks
     def list_pipeline_files(self):
+        if self.is_mirror:
+            rv = yield self.list_mirror_pipeline_files()
+            return rv
+
         workdir = os.path.join(self.getProperty('builddir'), self.workdir)
         wc_path = Path(workdir)
         buildbot_path = wc_path / self.getProperty('pipeline_stepsdir', DEFAULT_STEPSDIR)
@@ -310,6 +664,12 @@ class GatherBuilders(buildstep.BuildStep):
             for it in buildbot_path.glob('**/*.yaml'):
                 result.append(extract_parts(it))
         else:
+            if self.bulk_fetch:
+                contents = yield self.fetch_pipeline_archive(buildbot_path)
+                if contents is not None:
+                    self.pipeline_contents = contents
+                    return [extract_parts(Path(it)) for it in contents]
+
             rv = yield utils.silent_remote_command(self, 'glob', path=str(buildbot_path / '**/*.yaml'))
             for it in rv.updates['files'][0]:
                 result.append(extract_parts(Path(it)))
@@ -317,9 +677,11 @@ class GatherBuilders(buildstep.BuildStep):
 
     @defer.inlineCallbacks
     def get_pipeline_content(self, fullpath):
-        if self.is_local:
-            with open(fullpath) as f:
-                return yaml.safe_load(f)
+        if fullpath in self.pipeline_contents:
+            return self.pipeline_contents[fullpath]
+        elif self.is_local:
+            with open(fullpath, 'rb') as f:
+                return f.read()
         else:
             writer = utils.BufWriter()
             try:
@@ -327,101 +689,173 @@ class GatherBuilders(buildstep.BuildStep):
                     self, 'uploadFile', workdir='/', workersrc=fullpath, writer=writer,
                     blocksize=16384, maxsize=1 << 20, keepstamp=False)
                 if rv.rc == results.SUCCESS:
-                    writer.buf.seek(0)
-                    return yaml.safe_load(writer.buf)
-                return None
+                    return writer.buf.getvalue()
+                raise Exception(f'Unable to fetch {fullpath}')
             finally:
                 writer.buf.close()
 
+    def get_tree_index(self):
+        return self.tree_lock.run(self._get_tree_index)
+
     @defer.inlineCallbacks
-    def run(self):
-        build_props = self.pipeline_build_props or self.getProperty('pipeline_build_props', {})
+    def _get_tree_index(self):
+        # repository tree is listed once and only if some pipeline needs it
+        if self.tree_index is None:
+            command = ['git', 'ls-tree', '-r', '-z', 'HEAD']
+            if self.is_mirror:
+                m = mirror.get_mirror(self.master.basedir, self.getProperty('repository'))
+                entries = yield m.list_tree(self.getProperty('got_revision'))
+            elif self.is_local:
+                workdir = os.path.join(self.getProperty('builddir'), self.workdir)
+                rc, stdout, stderr = yield runprocess.run_process(reactor, command, workdir=workdir)
+                if rc != 0:
+                    raise Exception(f'git ls-tree failed: {stderr.decode(errors="replace").strip()}')
+                entries = mirror.parse_ls_tree(stdout)
+            else:
+                workdir = os.path.join(self.getProperty('builddir'), self.workdir)
+                stdout = yield utils.run_shell(self, workdir, command)
+                entries = mirror.parse_ls_tree(stdout)
+            shas = dict(entries)
+            self.tree_index = filters.FilesIndex(list(shas)), shas
+        return self.tree_index
+
+    @defer.inlineCallbacks
+    def get_input_hash(self, step, content, props):
+        # hash of a pipeline definition, its properties and tree entries matched
+        # by its file filter, whole tree is used for pipelines without file filters
+        index, shas = yield self.get_tree_index()
+        patterns = filters.file_patterns(step.get('filter', {}))
+        if patterns:
+            files = sorted({f for p in patterns for f in index.select(p)})
+        else:
+            files = index.sorted_files
+
+        h = hashlib.sha256(git_blob_hash(content).encode())
+        h.update(json.dumps(props, sort_keys=True, default=str).encode())
+        for f in files:
+            h.update(f'\0{f}\0{shas[f]}'.encode())
+        return h.hexdigest()
+
+    @defer.inlineCallbacks
+    def evaluate_pipeline(self, name, fullpath, repopath, repo, changes, build_props):
         forced_builders = build_props.get('builders')
         common_props = build_props.get('common_props', {})
         builder_props = build_props.get('builder_props', {})
 
+        rv = utils.adict(result=results.SUCCESS, step=None, schedulers=[], logs=[])
+        skip_reason = 'unknown'
+        start_build = None
+
+        if forced_builders:
+            start_build = name in forced_builders
+            if not start_build:
+                return None
+
+        try:
+            content = yield self.get_pipeline_content(fullpath)
+            entry = load_pipeline(content)
+            step = entry.pipeline()
+        except Exception as e:
+            rv['result'] = results.WARNINGS
+            rv.logs.append((name, Failure(e).getTraceback()))
+            return rv
+
+        if not step:
+            return None
+
+        if self.is_local and not self.pipeline_build_props:
+            for it in step.get('schedulers', []):
+                try:
+                    it['builder'] = name
+                    it['name'] = f'{name}/{it["name"]}'
+                    it['repo'] = repo
+                    rv.schedulers.append(it)
+                except Exception as e:
+                    rv.logs.append((name + '/scheduler', Failure(e).getTraceback()))
+                    break
+
+        step['name'] = name
+        step['steps'].insert(0, {'git': True, 'repourl': repo})
+
+        if step.get('disabled'):
+            start_build = False
+            skip_reason = 'disabled'
+
+        if changes:
+            if start_build is None and repopath in changes[0].files:
+                start_build = True
+
+            if start_build is None and 'filter' in step:
+                try:
+                    flt = entry.get_filter()
+                except Exception as e:
+                    rv['result'] = results.WARNINGS
+                    skip_reason = str(e)
+                    rv.logs.append((name, str(e)))
+                else:
+                    if flt and flt(changes[0]):
+                        start_build = True
+                    else:
+                        skip_reason = 'filter'
+
+        if start_build:
+            props = step.get('properties', {}).copy()
+            props.update(common_props)
+            props.update(builder_props.get(name, {}))
+            if props:
+                props['pipeline_passthrough_props'] = list(props)
+
+            props.update(step.get('local_properties', {}))
+
+            # skip_unchanged: reuse a successful build with the same inputs
+            if step.get('skip_unchanged'):
+                try:
+                    props['pipeline_input_hash'] = yield self.get_input_hash(step, content, props)
+                except Exception as e:
+                    rv.logs.append((name + '/input-hash', Failure(e).getTraceback()))
+
+            step['properties'] = props
+            rv['step'] = step
+        else:
+            rv.logs.append((name, f'skipped by: {skip_reason}'))
+
+        return rv
+
+    @defer.inlineCallbacks
+    def run(self):
+        build_props = self.pipeline_build_props or self.getProperty('pipeline_build_props', {})
+
         if not self.getProperty('revision') and self.getProperty('got_revision'):
             self.setProperty('revision', self.getProperty('got_revision'), 'Build')
 
-        schedulers = []
-
         branch = self.getProperty('branch')
         repo = self.getProperty('repository')
-        result = results.SUCCESS
-        step_info = []
         changes = list(self.build.allChanges())
+        if changes:
+            changes[0].props = self.getProperties()
+
         pipelines = yield self.list_pipeline_files()
-        for name, fullpath, repopath in pipelines:
-            skip_reason = 'unknown'
-            start_build = None
 
-            if forced_builders:
-                start_build = name in forced_builders
-                if not start_build:
-                    continue
+        # pipelines are fetched and evaluated concurrently, results are merged
+        # in a listing order to keep logs and started jobs deterministic
+        evaluated = yield utils.gather_bounded(GATHER_CONCURRENCY, [
+            (self.evaluate_pipeline, name, fullpath, repopath, repo, changes, build_props)
+            for name, fullpath, repopath in pipelines])
 
-            try:
-                step = yield self.get_pipeline_content(fullpath)
-                step = normalize_pipeline(step)
-            except Exception as e:
-                result = results.WARNINGS
-                yield self.addCompleteLog(name, Failure(e).getTraceback())
+        result = results.SUCCESS
+        schedulers = []
+        step_info = []
+        for it in evaluated:
+            if it is None:
                 continue
 
-            if not step:
-                continue
+            result = max(result, it.result)
+            for log_name, content in it.logs:
+                yield self.addCompleteLog(log_name, content)
 
-            if self.is_local and not self.pipeline_build_props:
-                for it in step.get('schedulers', []):
-                    try:
-                        it['builder'] = name
-                        it['name'] = f'{name}/{it["name"]}'
-                        it['repo'] = repo
-                        schedulers.append(it)
-                    except Exception as e:
-                        yield self.addCompleteLog(name + '/scheduler', Failure(e).getTraceback())
-                        break
-
-            step['name'] = name
-            step['steps'].insert(0, {'git': True, 'repourl': repo})
-
-            if step.get('disabled'):
-                start_build = False
-                skip_reason = 'disabled'
-
-            if changes:
-                if start_build is None and repopath in changes[0].files:
-                    start_build = True
-
-                if start_build is None and 'filter' in step:
-                    if 'status' not in step['filter']:
-                        step['filter']['status'] = 'new'
-
-                    try:
-                        flt = filters.make_filters(step['filter'])
-                    except Exception as e:
-                        result = results.WARNINGS
-                        skip_reason = str(e)
-                        yield self.addCompleteLog(name, str(e))
-                    else:
-                        changes[0].props = self.getProperties()
-                        if flt and flt(changes[0]):
-                            start_build = True
-                        else:
-                            skip_reason = 'filter'
-
-            if start_build:
-                props = step.get('properties', {}).copy()
-                props.update(common_props)
-                props.update(builder_props.get(name, {}))
-                if props:
-                    props['pipeline_passthrough_props'] = list(props)
-
-                props.update(step.get('local_properties', {}))
-                step['properties'] = props
-                step_info.append(step)
-            else:
-                yield self.addCompleteLog(name, f'skipped by: {skip_reason}')
+            schedulers.extend(it.schedulers)
+            if it.step:
+                step_info.append(it.step)
 
         if schedulers:
             yield bbp_schedulers.update_schedulers(self.master, branch, schedulers)
@@ -457,86 +891,250 @@ def do_step_if(step_data):
 
 
 class DistributeStep(buildstep.BuildStep):
+    def __init__(self, discovery='checkout', **kwargs):
+        self.discovery = discovery
+        super().__init__(**kwargs)
+
     def run(self):
         repo = self.getProperty('repository')
         _, _, self.build.workdir = repo.rpartition('/')
-        self.build.addStepsAfterCurrentStep([git.Git(repourl=repo, **_vcs_opts), GatherBuilders()])
+        if self.discovery == 'mirror':
+            self.build.addStepsAfterCurrentStep([GatherBuilders(mirror=True)])
+        else:
+            self.build.addStepsAfterCurrentStep([git.Git(repourl=repo, **_vcs_opts), GatherBuilders()])
         return results.SUCCESS
 
 
+class PipelineMarkupObserver(logobserver.LogLineObserver):
+    # Recognizes stdout markup as lines arrive. Only a dynamic steps block is
+    # buffered, links and properties are applied immediately.
+    start_marker = '__PIPELINE_' + 'START__'
+    end_marker = '__PIPELINE_' + 'END__'
+    prop_re = re.compile('__PIPELINE_' + r'PROP__\s+(.+)$')
+    session_prop_re = re.compile('__PIPELINE_' + r'SESSION_PROP__\s+(.+)$')
+    link_re = re.compile('__PIPELINE_' + r'LINK__\s+(.+)$')
+
+    def __init__(self):
+        super().__init__()
+        self.setMaxLineLength(MARKUP_MAX_LINE_LENGTH)
+        self.block = None
+        self.steps_data = None
+        self.session_props = False
+        # applied markup, kept to replay it for cached steps
+        self.urls = []
+        self.props = []
+        self.pending = defer.succeed(None)
+
+    def chain(self, fn, *args):
+        self.pending.addCallback(lambda _: fn(*args))
+
+    def wait(self):
+        if self.session_props:
+            self.chain(self.step.build.flushSessionProperties)
+        return self.pending
+
+    def outLineReceived(self, line):
+        if '__PIPELINE_' not in line and self.block is None:
+            return
+
+        if self.block is not None:
+            data, found, _ = line.partition(self.end_marker)
+            self.block.append(data)
+            if found:
+                self.steps_data = '\n'.join(self.block)
+                self.block = None
+        elif self.steps_data is None and self.start_marker in line:
+            _, _, data = line.partition(self.start_marker)
+            data, found, _ = data.partition(self.end_marker)
+            if found:
+                self.steps_data = data
+            else:
+                self.block = [data]
+
+        m = self.link_re.search(line)
+        if m:
+            try:
+                parts = shlex.split(m[1])
+            except ValueError:
+                parts = []
+            if len(parts) >= 2:
+                self.urls.append(parts[:2])
+                self.chain(self.step.addURL, parts[0], parts[1])
+
+        m = self.prop_re.search(line) or self.session_prop_re.search(line)
+        if m:
+            parts = m[1].split(None, 1)
+            if len(parts) == 2:
+                name, value = parts
+                self.props.append((name, value, m.re is self.session_prop_re))
+                self.step.setProperty(name, value, 'Build')
+                if m.re is self.session_prop_re:
+                    # coalesced by the build, flushed in wait()
+                    self.step.build.setSessionProperty(name, value, 'Build')
+                    self.session_props = True
+
+
 class DynamicStep(buildstep.ShellMixin, buildstep.BuildStep):
     logEnviron = False
 
     def __init__(self, **kwargs):
         self.junit = kwargs.pop('junit', None)
         self.upload = kwargs.pop('upload', None)
+        self.cache = kwargs.pop('cache', None)
+        self.junit_counter = itertools.count()
         kwargs = self.setupShellMixin(kwargs)
         super().__init__(**kwargs)
-        self.observer = logobserver.BufferLogObserver()
+        self.observer = PipelineMarkupObserver()
         self.addLogObserver('stdio', self.observer)
 
-    def extract_steps(self, stdout):
-        m = re.search('(?s)__PIPELINE_' + 'START__(.*)__PIPELINE_' + 'END__', stdout)
-        if not m:
+    def extract_steps(self, data):
+        if data is None:
             return []
 
-        data = yaml.safe_load(m[1])
+        data = yaml.safe_load(data)
         return utils.ensure_list(gen_steps(self, data))
 
-    def extract_props(self, stdout):
-        r = '(?m)__PIPELINE_' + r'PROP__\s+(.+)$'
-        for data in re.findall(r, stdout):
-            name, value = data.split(None, 1)
-            yield name, value
-
-    def extract_session_props(self, stdout):
-        r = '(?m)__PIPELINE_' + r'SESSION_PROP__\s+(.+)$'
-        for data in re.findall(r, stdout):
-            name, value = data.split(None, 1)
-            yield name, value
-
-    def extract_links(self, stdout):
-        r = '(?m)__PIPELINE_' + r'LINK__\s+(.+)$'
-        for data in re.findall(r, stdout):
-            parts = shlex.split(data)
-            if len(parts) >= 2:
-                yield parts[:2]
-
     @defer.inlineCallbacks
     def run(self):
-        cmd = yield self.makeRemoteShellCommand()
-        yield self.runCommand(cmd)
-        result = cmd.results()
-        stdout = self.observer.getStdout()
-        if result == results.SUCCESS:
-            self.build.addStepsAfterCurrentStep(self.extract_steps(stdout))
-
-        for name, url in self.extract_links(stdout):
-            yield self.addURL(name, url)
-
-        for name, value in self.extract_props(stdout):
-            yield self.setProperty(name, value, 'Build')
+        cache_key = meta = None
+        if self.cache:
+            cache = yield self.render(self.cache)
+            cache_key, meta = yield self.checkCache(cache)
+
+        if meta is not None:
+            result = meta['result']
+            steps_data = meta['steps_data']
+        else:
+            cmd = yield self.makeRemoteShellCommand()
+            yield self.runCommand(cmd)
+            result = cmd.results()
+            yield self.observer.wait()
+            steps_data = self.observer.steps_data
 
-        for name, value in self.extract_session_props(stdout):
-            yield self.setProperty(name, value, 'Build')
-            yield self.build.setSessionProperty(name, value, 'Build')
+        if result == results.SUCCESS:
+            self.build.addStepsAfterCurrentStep(self.extract_steps(steps_data))
 
         if self.junit:
             for desc in utils.ensure_list(self.junit):
                 yield self.handleJUnit(desc)
 
         if self.upload:
-            for desc in utils.ensure_list(self.upload):
-                yield self.handleUpload(desc)
+            yield utils.gather_bounded(TRANSFER_CONCURRENCY, [
+                (self.handleUpload, desc) for desc in utils.ensure_list(self.upload)])
+
+        if cache_key and meta is None and result in (results.SUCCESS, results.WARNINGS):
+            try:
+                yield self.storeCache(cache, cache_key, result)
+            except Exception as e:
+                yield self.addCompleteLog('cache', f'Unable to store step cache {cache_key}: {e}')
 
         return result
 
+    # cache: {inputs: globs, outputs: globs, key: extra value}
+    # Key covers rendered command, env and content of input files. Cached
+    # entry keeps outputs (junit reports included) and applied markup.
+    # Hashing and packing use sha256sum/xargs/tar on a worker.
+    @defer.inlineCallbacks
+    def checkCache(self, cache):
+        try:
+            files = yield utils.glob_files(self, cache.get('inputs'))
+            inputs = ''
+            if files:
+                inputs = yield self.runShell(['xargs', '-0', 'sha256sum', '--'], '\0'.join(files))
+            env = {k: v for k, v in (self.env or {}).items() if k not in BUILD_ENV_NAMES}
+            # steps differing only in collected outputs must not share entries
+            outputs = yield self.render({'outputs': cache.get('outputs'), 'junit': self.junit,
+                                         'upload': self.upload})
+            key = step_cache.make_key(self.command, env, inputs, [cache.get('key'), outputs])
+            meta, archive = yield step_cache.load(self.master.basedir, key)
+            if meta is not None:
+                if archive:
+                    yield self.restoreCacheArchive(key, archive)
+                yield self.replayMarkup(meta)
+                yield self.addCompleteLog('cache', f'Restored from step cache {key}\n')
+            return key, meta
+        except Exception as e:
+            yield self.addCompleteLog('cache', f'Step cache is not available: {e}\n')
+            return None, None
+
+    @defer.inlineCallbacks
+    def replayMarkup(self, meta):
+        for name, url in meta['urls']:
+            yield self.addURL(name, url)
+        for name, value, session in meta['props']:
+            self.setProperty(name, value, 'Build')
+            if session:
+                self.build.setSessionProperty(name, value, 'Build')
+        if any(it[2] for it in meta['props']):
+            yield self.build.flushSessionProperties()
+
+    @defer.inlineCallbacks
+    def storeCache(self, cache, key, result):
+        outputs = utils.ensure_list(cache.get('outputs') or [])
+        for desc in utils.ensure_list(self.junit or []):
+            desc = yield self.render(desc)
+            outputs.append(desc.get('src') if type(desc) is dict else desc)
+
+        archive = None
+        files = yield utils.glob_files(self, outputs)
+        try:
+            if files:
+                # concurrent misses of the same key upload to own files
+                cache_dir = os.path.join(self.master.basedir, step_cache.CACHE_DIR)
+                os.makedirs(cache_dir, exist_ok=True)
+                fd, archive = tempfile.mkstemp(dir=cache_dir, prefix=f'{key}.', suffix='.upload')
+                os.close(fd)
+                workerfile = f'.bbp-cache-{key}.tar.gz'
+                try:
+                    yield self.runShell(['tar', '-czf', workerfile, '--null', '-T', '-'], '\0'.join(files))
+                    rv = yield utils.silent_remote_command(
+                        self, 'uploadFile', workdir=utils.get_workdir(self), workersrc=workerfile,
+                        writer=remotetransfer.FileWriter(archive, STEP_CACHE_MAXSIZE, None),
+                        blocksize=1 << 16, maxsize=STEP_CACHE_MAXSIZE, keepstamp=False)
+                finally:
+                    yield self.runShell(['rm', '-f', workerfile])
+                if rv.rc != results.SUCCESS:
+                    raise Exception(f'upload of outputs failed (maxsize: {STEP_CACHE_MAXSIZE})')
+
+            meta = {
+                'result': result,
+                'steps_data': self.observer.steps_data,
+                'urls': self.observer.urls,
+                'props': self.observer.props,
+            }
+            yield step_cache.store(self.master.basedir, key, meta, archive)
+        finally:
+            # store moves the archive into an entry, anything left is garbage
+            if archive and os.path.exists(archive):
+                os.unlink(archive)
+
+    @defer.inlineCallbacks
+    def restoreCacheArchive(self, key, archive):
+        workerfile = f'.bbp-cache-{key}.tar.gz'
+        with open(archive, 'rb') as f:
+            rv = yield utils.silent_remote_command(
+                self, 'downloadFile', workdir=utils.get_workdir(self), workerdest=workerfile,
+                reader=remotetransfer.FileReader(f), maxsize=None, blocksize=1 << 16, mode=None)
+        if rv.rc != results.SUCCESS:
+            raise Exception('download of cached outputs failed')
+        try:
+            yield self.runShell(['tar', '-xzf', workerfile])
+        finally:
+            yield self.runShell(['rm', '-f', workerfile])
+
+    def runShell(self, command, stdin=None):
+        return utils.run_shell(self, utils.get_workdir(self), command, stdin, self.env)
+
     @defer.inlineCallbacks
     def handleJUnit(self, desc):
         desc = yield self.render(desc)
+        maxsize = JUNIT_MAXSIZE
+        report_mode = JUNIT_REPORT_MODE
         if type(desc) is dict:
             label = desc.get('label')
             src = desc.get('src')
+            maxsize = desc.get('maxsize', maxsize)
+            report_mode = desc.get('report', report_mode)
         else:
             label = None
             src = desc
@@ -546,28 +1144,79 @@ class DynamicStep(buildstep.ShellMixin, buildstep.BuildStep):
 
         wd = utils.get_workdir(self)
         rv = yield utils.silent_remote_command(self, 'glob', path=os.path.join(wd, src))
-        for fname in rv.updates['files'][0]:
-            writer = utils.BufWriter()
+        reports = yield utils.gather_bounded(TRANSFER_CONCURRENCY, [
+            (self.fetchJUnitReport, fname, maxsize, report_mode) for fname in rv.updates['files'][0]])
 
-            rv = yield utils.silent_remote_command(
-                self, 'uploadFile', workdir='/', workersrc=fname, writer=writer,
-                blocksize=16384, maxsize=1 << 20, keepstamp=False)
+        durations = {}
+        for error, suites, report_url, report_timings in reports:
+            if error:
+                yield self.addCompleteLog(label or 'junit', error)
+                continue
 
-            if rv.rc == results.SUCCESS:
-                writer.buf.seek(0)
-                suites = junit.parse(writer.buf)
-                writer.buf.close()
-                h = junit.gen_html(suites, embed=True)
-                n = label or (suites and suites[0]['name'] or 'tests')
-                yield self.addHTMLLog(n, h)
+            for unit, duration in report_timings.items():
+                durations[unit] = durations.get(unit, 0.0) + duration
+
+            h = junit.gen_html(suites, embed=True, full_report_url=report_url)
+            n = label or (suites and suites[0]['name'] or 'tests')
+            yield self.addHTMLLog(n, h)
+
+        shard_key = self.getProperty('shard_key')
+        if shard_key and durations:
+            yield timings.update(self.master, shard_key, durations)
 
     @defer.inlineCallbacks
-    def handleUpload(self, desc):
-        desc = yield self.render(desc)
+    def fetchJUnitReport(self, fname, maxsize, report_mode):
+        report_file = report_url = sink = None
+        if file_store.ep.path:
+            url, storage_path = self.get_storage()
+            report_name = f'junit/{self.stepid}-{next(self.junit_counter)}.jsonl'
+            report_url = url + report_name
+            report_file = os.path.join(storage_path, report_name)
+            os.makedirs(os.path.dirname(report_file), exist_ok=True)
+            sink = junit.JSONLinesSink(open(report_file, 'wb'))
+
+        keep_passed = 0 if report_mode == 'summary' else junit.KEEP_PASSED
+        parser = junit.JUnitParser(keep_passed, sink)
+        try:
+            rv = yield utils.silent_remote_command(
+                self, 'uploadFile', workdir='/', workersrc=fname, writer=utils.FeedWriter(parser.feed),
+                blocksize=1 << 16, maxsize=maxsize, keepstamp=False)
+            suites = parser.close()
+        except Exception:
+            # partial report of a failed upload is useless
+            sink and os.unlink(report_file)
+            raise
+        finally:
+            sink and sink.fileobj.close()
+
+        error = None
+        if rv.rc != results.SUCCESS:
+            error = f'Unable to upload {fname} (maxsize: {maxsize})'
+        elif parser.error is not None:
+            error = f'Unable to parse {fname}: {parser.error}'
+
+        if error:
+            sink and os.unlink(report_file)
+            return error, None, None, None
+
+        if sink and not sink.count:
+            os.unlink(report_file)
+            report_url = None
+        elif sink:
+            yield file_store.ep.register_upload(storage_path, {report_file: None})
+
+        return None, suites, report_url, parser.timings
+
+    def get_storage(self):
         bname = build.builder_name_to_path(self.getProperty('virtual_builder_name') or self.getProperty('buildername'))
         bnum = self.getProperty('pipeline_buildnumber') or self.getProperty('buildnumber')
+        path = os.path.realpath(os.path.join(file_store.ep.path, bname, str(bnum)))
+        return f'/file-store/{bname}/{bnum}/', path
 
-        build_storage_path = os.path.realpath(os.path.join(file_store.ep.path, bname, str(bnum)))
+    @defer.inlineCallbacks
+    def handleUpload(self, desc):
+        desc = yield self.render(desc)
+        url, build_storage_path = self.get_storage()
         if desc.get('dest'):
             dest = os.path.realpath(os.path.join(build_storage_path, desc['dest']))
             if len(os.path.commonpath([dest, build_storage_path])) < len(build_storage_path):
@@ -575,20 +1224,101 @@ class DynamicStep(buildstep.ShellMixin, buildstep.BuildStep):
         else:
             dest = build_storage_path
 
-        cmd = MultipleFileUpload(
-            workersrcs=utils.ensure_list(desc['src']),
-            glob=True,
-            url=f'/file-store/{bname}/{bnum}/' + desc.get('link', ''),
-            urlText=desc.get('label'),
-            masterdest=dest)
-
-        cmd.setBuild(self.build)
-        cmd.setWorker(self.worker)
-        cmd.stepid = self.stepid
-        cmd._running = True
-        cmd.remote = self.remote
-        cmd.addLog = lambda name: defer.succeed(self.getLog(name))
-        yield cmd.run()
+        srcs = utils.ensure_list(desc['src'])
+        glob = True
+        written = {}
+        if file_store.ep.dedupe:
+            try:
+                srcs, written = yield self.linkKnownBlobs(srcs, dest)
+                glob = False
+            except Exception as e:
+                log.msg(f'file-store: unable to hash upload sources: {e}')
+
+        if srcs:
+            cmd = PipelineUpload(
+                written=written,
+                workersrcs=srcs,
+                glob=glob,
+                url=url + desc.get('link', ''),
+                urlText=desc.get('label'),
+                compress=desc.get('compress', UPLOAD_COMPRESS),
+                masterdest=dest)
+
+            cmd.setBuild(self.build)
+            cmd.setWorker(self.worker)
+            cmd.stepid = self.stepid
+            cmd._running = True
+            cmd.remote = self.remote
+            cmd.addLog = self.getOrAddLog
+            yield cmd.run()
+        elif written:
+            yield self.addURL(desc.get('label') or os.path.basename(os.path.normpath(dest)),
+                              url + desc.get('link', ''))
+        yield file_store.ep.register_upload(build_storage_path, written)
+
+    def getOrAddLog(self, name):
+        # cached steps don't run a command and have no stdio log
+        if name in self.logs:
+            return defer.succeed(self.logs[name])
+        return self.addLog(name)
+
+    @defer.inlineCallbacks
+    def linkKnownBlobs(self, srcs, dest):
+        # Files with content already in the store are linked from blobs
+        # instead of being transferred. Returns sources left to upload and
+        # {dest file: hash} of linked ones.
+        files = yield utils.glob_files(self, srcs)
+        if not files:
+            return files, {}
+
+        # step env is pipeline controlled, worker output is validated anyway
+        out = yield utils.run_shell(
+            self, utils.get_workdir(self),
+            ['xargs', '-0', 'sh', '-c', 'for f; do if [ -f "$f" ]; then sha256sum -- "$f"; fi; done', 'sh'],
+            '\0'.join(files))
+        known = {}
+        allowed = set(files)
+        for line in out.splitlines():
+            # names with special chars are escaped and start with a backslash
+            h, sep, fname = line.partition('  ')
+            if sep and file_store.is_hash(h) and fname in allowed and os.path.basename(fname) not in ('', '.', '..'):
+                known[fname] = h
+
+        linked = yield file_store.ep.link_known_blobs(
+            {os.path.join(dest, os.path.basename(it)): h for it, h in known.items()})
+        return [it for it in files if os.path.join(dest, os.path.basename(it)) not in linked], linked
+
+
+class PipelineUpload(MultipleFileUpload):
+    # uploads through copy-on-write file store writers and collects written
+    # files into a passed dict
+    def __init__(self, written, **kwargs):
+        super().__init__(**kwargs)
+        self.written = written
+
+    def uploadFile(self, source, masterdest):
+        writer = file_store.StoreFileWriter(masterdest, self.maxsize, self.mode, self.written)
+        cmd = makeStatusRemoteCommand(self, 'uploadFile', {
+            'workdir': self.workdir,
+            'workersrc': source,
+            'writer': writer,
+            'maxsize': self.maxsize,
+            'blocksize': self.blocksize,
+            'keepstamp': self.keepstamp,
+        })
+        return self.runTransferCommand(cmd, writer)
+
+    def uploadDirectory(self, source, masterdest):
+        writer = file_store.StoreDirectoryWriter(masterdest, self.maxsize, self.compress, 0o600, self.written)
+        cmd = makeStatusRemoteCommand(self, 'uploadDirectory', {
+            'workdir': self.workdir,
+            'workersrc': source,
+            'writer': writer,
+            'maxsize': self.maxsize,
+            'blocksize': self.blocksize,
+            'compress': self.compress,
+        })
+        return self.runTransferCommand(cmd, writer)
 
 
 _vcs_opts = {'logEnviron': False, 'mode': 'full', 'method': 'fresh'}
@@ -0,0 +1,73 @@
+import time
+import heapq
+import statistics
+
+import sqlalchemy as sa
+
+from buildbot_pipeline import build
+
+# weight of a new measurement in a moving average of test durations
+SMOOTHING = 0.5
+
+
+def get(master, key):
+    t = build.unit_timings
+
+    def thd(conn):
+        q = sa.select([t.c.unit, t.c.duration]).where(t.c.key == key)
+        return dict(conn.execute(q).fetchall())
+    return master.db.pool.do(thd)
+
+
+def update(master, key, timings):
+    t = build.unit_timings
+
+    def thd(conn):
+        now = int(time.time())
+        transaction = conn.begin()
+        q = sa.select([t.c.unit, t.c.duration]).where(t.c.key == key)
+        known = dict(conn.execute(q).fetchall())
+        updates = [{'b_unit': unit, 'b_updated': now,
+                    'b_duration': known[unit] * (1 - SMOOTHING) + duration * SMOOTHING}
+                   for unit, duration in timings.items() if unit in known]
+        if updates:
+            conn.execute(t.update()
+                         .where(t.c.key == key, t.c.unit == sa.bindparam('b_unit'))
+                         .values(duration=sa.bindparam('b_duration'), updated=sa.bindparam('b_updated')),
+                         updates)
+        rows = [{'key': key, 'unit': unit, 'duration': duration, 'updated': now}
+                for unit, duration in timings.items() if unit not in known]
+        if rows:
+            conn.execute(t.insert(), rows)
+        transaction.commit()
+    return master.db.pool.do(thd)
+
+
+def file_weights(timings):
+    # junit units are files (if a reporter sets testcase file attribute) or
+    # dotted classnames, classname durations are also accounted to every
+    # module path it could come from: a.b.C -> a.py, a/b.py, a/b/C.py
+    result = {}
+    for unit, duration in timings.items():
+        result[unit] = result.get(unit, 0.0) + duration
+        if '/' in unit or '.' not in unit:
+            continue
+        parts = unit.split('.')
+        for i in range(1, len(parts) + 1):
+            path = '/'.join(parts[:i]) + '.py'
+            result[path] = result.get(path, 0.0) + duration
+    return result
+
+
+def balance(items, weights, count):
+    # longest processing time first: heaviest item goes to the lightest shard,
+    # items without history are assumed to take a median time
+    known = [weights[it] for it in items if it in weights]
+    default = statistics.median(known) if known else 1.0
+    shards = [[] for _ in range(count)]
+    heap = [(0.0, i) for i in range(count)]
+    for it in sorted(items, key=lambda it: (-weights.get(it, default), it)):
+        total, i = heapq.heappop(heap)
+        shards[i].append(it)
+        heapq.heappush(heap, (total + weights.get(it, default), i))
+    return [sorted(it) for it in shards]
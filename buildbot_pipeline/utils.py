@@ -1,5 +1,7 @@
 import io
+import os
 import functools
+import collections
 
 from twisted.internet import defer
 
@@ -80,6 +82,42 @@ def silent_remote_command(step, command, collectStdout=False, **kwargs):
     return cmd.run(None, step.remote, step.build.builder.name)
 
 
+@defer.inlineCallbacks
+def glob_files(step, patterns, workdir=None):
+    # expands patterns on a worker, returns sorted paths relative to workdir
+    wd = workdir or get_workdir(step)
+    files = set()
+    for p in ensure_list(patterns or []):
+        rv = yield silent_remote_command(step, 'glob', path=os.path.join(wd, p))
+        files.update(os.path.relpath(it, wd) for it in rv.updates['files'][0])
+    return sorted(files)
+
+
+@defer.inlineCallbacks
+def run_shell(step, workdir, command, stdin=None, env=None):
+    # runs a helper command on a worker without a log, returns its stdout
+    cmd = remotecommand.RemoteShellCommand(
+        workdir, command, env=env, logEnviron=False,
+        collectStdout=True, initialStdin=stdin, stdioLogName=None)
+    cmd.worker = step.worker
+    yield cmd.run(step, step.remote, step.build.builder.name)
+    if cmd.rc != 0:
+        raise Exception(f'{command[0]} failed with exit code {cmd.rc}')
+    return cmd.stdout
+
+
+def _unwrap_first_error(failure):
+    failure.trap(defer.FirstError)
+    return failure.value.subFailure
+
+
+def gather_bounded(limit, calls):
+    # calls is a list of (fn, *args), results are returned in the same order
+    sem = defer.DeferredSemaphore(limit)
+    d = defer.gatherResults([sem.run(*it) for it in calls], consumeErrors=True)
+    return d.addErrback(_unwrap_first_error)
+
+
 def hide_if_success(result, step):
     return result == SUCCESS
 
@@ -95,6 +133,22 @@ class BufWriter(base.FileWriterImpl):
         pass
 
 
+class FeedWriter(base.FileWriterImpl):
+    def __init__(self, feed):
+        self.feed = feed
+
+    def remote_write(self, data):
+        self.feed(data)
+
+    def remote_close(self):
+        pass
+
+
+class ArchiveWriter(BufWriter):
+    def remote_unpack(self):
+        pass
+
+
 def wrapit(obj, attr=None):
     def decorator(fn):
         lattr =  attr or fn.__name__
@@ -120,6 +174,36 @@ def add_method(obj, attr=None):
     return decorator
 
 
+class LRUCache:
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+
 class adict(dict):
     __getattr__ = dict.__getitem__
 
@@ -0,0 +1,78 @@
+import os
+import stat
+import shutil
+import tempfile
+from unittest import mock
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from buildbot.process import results
+from buildbot.test.reactor import TestReactorMixin
+from buildbot.test.steps import TestBuildStepMixin, ExpectGlob, ExpectStat, ExpectUploadFile
+
+from buildbot_pipeline import steps, file_store
+
+
+class TestDynamicStepCache(TestBuildStepMixin, TestReactorMixin, unittest.TestCase):
+    def setUp(self):
+        self.setup_test_reactor()
+        self.store = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.store)
+        self.patch(file_store.ep, 'path', self.store)
+        self.patch(file_store.ep, 'index', None)
+        self.patch(file_store.ep, 'dedupe', False)
+        return self.setup_test_build_step()
+
+    @defer.inlineCallbacks
+    def test_cache_hit_with_upload(self):
+        step = self.setup_step(steps.DynamicStep(
+            command='make', cache={'inputs': 'src'}, upload={'src': 'report.txt', 'link': 'report.txt'}))
+        self.build.addStepsAfterCurrentStep = mock.Mock()
+        self.build.setProperty('buildername', 'b', 'Build')
+        self.build.setProperty('buildnumber', 1, 'Build')
+        meta = {'result': results.SUCCESS, 'steps_data': None, 'urls': [], 'props': []}
+        step.checkCache = mock.Mock(return_value=defer.succeed(('key', meta)))
+
+        self.expect_commands(
+            ExpectGlob(path='build/report.txt', log_environ=False).files(['build/report.txt']).exit(0),
+            ExpectStat(file='build/report.txt', workdir='build').stat(stat.S_IFREG).exit(0),
+            ExpectUploadFile(workersrc='build/report.txt', workdir='build', blocksize=16384,
+                             maxsize=None, keepstamp=False, writer=mock.ANY)
+            .upload_string('ok').exit(0))
+        self.expect_outcome(result=results.SUCCESS)
+        yield self.run_step()
+
+        with open(os.path.join(self.store, 'b', '1', 'report.txt')) as f:
+            self.assertEqual(f.read(), 'ok')
+
+
+class TestParallel(TestBuildStepMixin, TestReactorMixin, unittest.TestCase):
+    def setUp(self):
+        self.setup_test_reactor()
+        return self.setup_test_build_step()
+
+    def setup_parallel(self, count, **kwargs):
+        step = self.setup_step(steps.Parallel(
+            [{'name': f'child{i}', 'properties': {}} for i in range(count)], inner=False, **kwargs))
+        entries = [{'sched_name': 'trig-prop-builder', 'props_to_set': {'n': i}, 'unimportant': False}
+                   for i in range(count)]
+        step.getSchedulersAndProperties = mock.Mock(return_value=defer.succeed(entries))
+        sch = mock.Mock()
+        sch.name = 'trig-prop-builder'
+        step.getSchedulerByName = mock.Mock(return_value=sch)
+        step.prepareSourcestampListForTrigger = mock.Mock(return_value=[])
+        return step
+
+    @defer.inlineCallbacks
+    def test_trigger_error_cancels_queued_children(self):
+        self.setup_parallel(3, max_parallel=1)
+        trigger_many = mock.Mock(side_effect=RuntimeError('db is gone'))
+        self.patch(steps.buildsets, 'trigger_many', trigger_many)
+
+        self.expect_outcome(result=results.EXCEPTION)
+        d = self.run_step()
+        self.assertTrue(d.called, 'step is still waiting for queued children')
+        yield d
+        self.assertEqual(trigger_many.call_count, 1)
+        self.assertIn('db is gone', self.step.logs['err.text'].stdout)